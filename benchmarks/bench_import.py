@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+
+"""
+
+Import benchmark.
+
+Measures what importing the middleware costs a node at startup, in fresh interpreters:
+
+- import_ms: cumulative time to import middleware, as reported by python -X importtime.
+- rss_kb: peak resident memory of an interpreter that only imported middleware.
+- heaviest: the modules imported by middleware that took longest to import, with their cumulative time.
+- loaded: whether heavy optional dependencies (requests, PIL, psutil, numpy) were imported.
+
+usage: python3 bench_import.py [output.json] [runs]
+
+"""
+
+
+import os
+import subprocess
+import sys
+
+from common import ROOT, summarize, metadata, write_results
+
+
+RUNS = 10
+TOP = 10
+HEAVY_MODULES = ("requests", "PIL", "psutil", "numpy")
+
+CHILD = f'''
+import resource, sys
+import middleware
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+'''
+
+
+def parse_importtime(report):
+    """
+    Parse the stderr of python -X importtime.
+    Returns a dictionary with the cumulative import time of middleware and of each module it imports, in microseconds.
+    """
+    modules = {}
+    children = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not cumulative_us.strip().isdigit():
+            continue
+        # nested imports are indented by two more spaces per level, and reported before their parent
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative_us)
+        elif depth == 0:
+            if name.strip() == "middleware":
+                modules.update(children)
+                modules["middleware"] = int(cumulative_us)
+            children = {}
+    return modules
+
+
+def run_once():
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "src"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    rss_kb, loaded = result.stdout.split("\n")[:2]
+    return parse_importtime(result.stderr), int(rss_kb), [m for m in loaded.split(",") if m]
+
+
+def run(runs):
+    times = []
+    rss = []
+    totals = {}
+    for _ in range(runs):
+        modules, rss_kb, loaded = run_once()
+        times.append(modules.pop("middleware") / 1e6)
+        rss.append(rss_kb)
+        for name, us in modules.items():
+            totals[name] = totals.get(name, 0) + us
+    heaviest = sorted(totals.items(), key=lambda kv: -kv[1])[:TOP]
+    return {
+        "meta": metadata(),
+        "runs": runs,
+        "import_ms": {k.replace("_us", "_ms"): v / 1000.0 for k, v in summarize(times).items() if k != "samples"},
+        "rss_kb": sum(rss) / len(rss),
+        "heaviest_ms": {name: us / runs / 1000.0 for name, us in heaviest},
+        "loaded": loaded,
+    }
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else None
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else RUNS
+    write_results(run(runs), output)
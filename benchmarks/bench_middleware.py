@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+
+
+"""
+
+Middleware benchmark suite.
+
+Measures what the middleware costs, using the entries defined in middleware.py:
+
+- entry_get / entry_set: latency of reading and writing single fields of Leds, Pan, Tilt, Speakers and Battery.
+- entry_snapshot: latency of reading several fields in one round trip.
+- entry_get_cached: entry_get with the field cache enabled.
+- status_update: wall time of the reads of robot_api.Robot.update_state(), the middleware part of /status,
+  with the cache enabled.
+- leds_publish: LED frames per second, with Leds.show() and with the legacy Leds.colors,
+  and the latency between showing a frame and the frame ring waking up a reader in another process.
+- end_to_end: latency between a write in one process and the moment another process observes it,
+  with Node.wait_for_change() and with a 100 ms polling loop.
+
+Runs against database 15 of the configured redis server, see benchmarks/common.py.
+Set MIDDLEWARE_BACKEND to run against the local or shared memory backends instead.
+
+usage: python3 bench_middleware.py [output.json] [iterations]
+
+Use compare.py to compare the results of two branches.
+
+"""
+
+
+import itertools
+import multiprocessing
+import struct
+import sys
+import time
+
+from common import time_calls, summarize, metadata, write_results
+import middleware as mw
+
+
+ITERATIONS = 1000
+END_TO_END_SAMPLES = 50
+
+# fields with the values they are written with, in turn
+FIELDS = [
+    (mw.Leds, "brightness", (0.3,)),
+    (mw.Pan, "angle", (10,)),
+    (mw.Pan, "min_angle", (-40,)),
+    (mw.Tilt, "current_angle", (-7.2,)),
+    (mw.Speakers, "volume", (18,)),
+    # the battery voltage has a deadband, writing the same value over and over would time suppressed writes
+    (mw.Battery, "voltage", (15.2, 15.3)),
+]
+
+
+def bench_entry_get(iterations):
+    results = {}
+    for cls, field, values in FIELDS:
+        entry = cls()
+        results[entry.key(field)] = time_calls(lambda: getattr(entry, field), iterations)
+    return results
+
+
+def bench_entry_set(iterations):
+    results = {}
+    for cls, field, values in FIELDS:
+        entry = cls()
+        writes = itertools.cycle(values)
+        results[entry.key(field)] = time_calls(lambda: setattr(entry, field, next(writes)), iterations)
+    return results
+
+
+def bench_entry_snapshot(iterations):
+    pan = mw.Pan()
+    touch_sensors = mw.TouchSensors()
+    raw_fields = ("chest_raw", "head_0_raw", "head_1_raw", "head_2_raw", "head_3_raw")
+    return {
+        "pan_all_fields": time_calls(lambda: pan.snapshot(), iterations),
+        "touch_sensors_raw": time_calls(lambda: touch_sensors.snapshot(raw_fields), iterations),
+    }
+
+
+def bench_status_update(iterations):
+    """
+    The reads of robot_api.Robot.update_state(), the middleware part of /status.
+    Done here on the entries, importing robot_api would set up its flask app.
+    """
+    requests = (
+        (mw.Battery(), ("voltage", "percentage")),
+        (mw.Pan(), ("current_angle", "min_angle", "max_angle", "enabled", "temperature")),
+        (mw.Tilt(), ("current_angle", "min_angle", "max_angle", "enabled", "temperature")),
+        (mw.TouchSensors(), ("touch_chest", "touch_head_0", "touch_head_1", "touch_head_2", "touch_head_3")),
+        (mw.Behaviours(), ("look_around", "blush")),
+        (mw.Speakers(), ("volume",)),
+        (mw.Server(), ("http_port",)),
+        (mw.Microphone(), ("is_recording",)),
+        (mw.Onboard(), ("speech",)),
+    )
+
+    def update_state():
+        mw.snapshot(*requests)
+        mw.read_ages([(entry, f) for entry, fields in requests for f in fields])
+
+    return {"update_state": time_calls(update_state, iterations)}
+
+
+def bench_leds_publish(iterations):
+    leds = mw.Leds()
+    frames = [leds.encode_colors([[i % 256, 0, 255 - i % 256]] * 169) for i in range(256)]
+    colors = [leds.decode_colors(frame) for frame in frames]
+    results = {}
+    t = time.perf_counter()
+    for i in range(iterations):
+        leds.show(frames[i % 256])
+    results["show_fps"] = iterations / (time.perf_counter() - t)
+    t = time.perf_counter()
+    for i in range(iterations):
+        leds.colors = colors[i % 256]
+    results["colors_fps"] = iterations / (time.perf_counter() - t)
+    results["frame_latency"] = bench_frame_latency(leds, END_TO_END_SAMPLES)
+    return results
+
+
+def read_frames(samples, ready, queue):
+    """
+    Frame reader process.
+    Waits for frames and reports how long ago they were shown.
+    The writer stores time.monotonic() in the first bytes of each frame.
+    """
+    frames = mw.Leds().frames()
+    sequence = frames.sequence()
+    frames.wait(sequence, timeout=0.0)
+    latencies = []
+    ready.set()
+    while len(latencies) < samples:
+        if frames.wait(sequence, timeout=1.0):
+            sequence, frame = frames.read()
+            latencies.append(time.monotonic() - struct.unpack_from("<d", frame)[0])
+    queue.put(latencies)
+
+
+def bench_frame_latency(leds, samples):
+    ready = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=read_frames, args=(samples, ready, queue))
+    reader.start()
+    ready.wait()
+    frame = bytearray(3 * leds.number)
+    for _ in range(samples):
+        time.sleep(1.0 / 60)
+        struct.pack_into("<d", frame, 0, time.monotonic())
+        leds.show(bytes(frame))
+    latencies = queue.get()
+    reader.join()
+    return summarize(latencies)
+
+
+def observe(mode, samples, ready, queue):
+    """
+    Observer process.
+    Waits for pan current_angle to change and reports how long ago it was written.
+    The writer stores time.monotonic(), which is shared by all processes on linux.
+    """
+    node = mw.Node("benchmark_observer")
+    pan = mw.Pan()
+    node.wait_for_change(pan, "current_angle", timeout=0.0)
+    latencies = []
+    last = pan.current_angle
+    ready.set()
+    while len(latencies) < samples:
+        if mode == "watch":
+            node.wait_for_change(pan, "current_angle", timeout=1.0)
+        else:
+            time.sleep(0.1)
+        value = pan.current_angle
+        if value != last:
+            latencies.append(time.monotonic() - value)
+            last = value
+    node.shutdown()
+    queue.put(latencies)
+
+
+def bench_end_to_end(samples):
+    if mw.BACKEND == "local":
+        return {"skipped": "the local backend is not shared between processes"}
+    results = {}
+    pan = mw.Pan()
+    for mode in ("watch", "poll_100ms"):
+        pan.current_angle = 0
+        ready = multiprocessing.Event()
+        queue = multiprocessing.Queue()
+        observer = multiprocessing.Process(target=observe, args=(mode, samples, ready, queue))
+        observer.start()
+        ready.wait()
+        for _ in range(samples):
+            time.sleep(0.15)
+            pan.current_angle = time.monotonic()
+        results[mode] = summarize(queue.get())
+        observer.join()
+    return results
+
+
+def run(iterations):
+    mw.delete_all()
+    mw.seed_defaults()
+    results = {
+        "meta": metadata(),
+        "iterations": iterations,
+        "entry_get": bench_entry_get(iterations),
+        "entry_set": bench_entry_set(iterations),
+        "entry_snapshot": bench_entry_snapshot(iterations),
+        "leds_publish": bench_leds_publish(iterations),
+        "end_to_end": bench_end_to_end(END_TO_END_SAMPLES),
+    }
+    # robot_api enables the field cache at startup, so these run with the cache on
+    mw.enable_cache()
+    results["entry_get_cached"] = bench_entry_get(iterations)
+    results["status_update"] = bench_status_update(iterations)
+    mw.delete_all()
+    return results
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else None
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else ITERATIONS
+    write_results(run(iterations), output)
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+
+
+"""
+
+Transport benchmark.
+
+Compares GET and SET latency over tcp and over a unix domain socket,
+using the payloads the middleware typically moves: a scalar field, a flag,
+the binary LED frame and the legacy json LED colors.
+
+The unix socket must be enabled in the redis configuration (unixsocket and unixsocketperm).
+
+usage: python3 bench_transport.py [unix_socket_path] [iterations]
+
+Results are printed as json.
+
+"""
+
+
+import json
+import os
+import sys
+import time
+
+from common import summarize, metadata, write_results
+import middleware as mw
+
+
+DEFAULT_SOCKET = "/var/run/redis/redis-server.sock"
+ITERATIONS = 2000
+
+PAYLOADS = {
+    "scalar": json.dumps(12.5),
+    "flag": json.dumps(True),
+    "leds_frame": bytes(169 * 3),
+    "leds_colors_json": json.dumps([[255, 128, 0]] * 169),
+}
+
+
+def measure(client, payload, iterations):
+    key = "benchmark_transport"
+    set_samples = []
+    get_samples = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        client.set(key, payload)
+        set_samples.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        client.get(key)
+        get_samples.append(time.perf_counter() - t)
+    client.delete(key)
+    return {"set": summarize(set_samples), "get": summarize(get_samples)}
+
+
+def run(unix_socket, iterations):
+    transports = {"tcp": mw.get_connection(unix_socket=None)}
+    if os.path.exists(unix_socket):
+        transports["unix"] = mw.get_connection(unix_socket=unix_socket)
+    results = {"meta": metadata(), "iterations": iterations, "transports": {}}
+    for name, client in transports.items():
+        results["transports"][name] = {
+            payload_name: measure(client, payload, iterations)
+            for payload_name, payload in PAYLOADS.items()
+        }
+    return results
+
+
+if __name__ == '__main__':
+    unix_socket = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else ITERATIONS
+    write_results(run(unix_socket, iterations))
@@ -0,0 +1,80 @@
+"""
+
+Helpers shared by the benchmarks.
+
+Importing this module makes src/ importable and, unless MIDDLEWARE_REDIS_DB is already set,
+points the middleware at redis database 15, so benchmarks never write to the fields a running robot uses.
+
+"""
+
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BENCHMARK_DB = "15"
+
+sys.path.insert(0, os.path.join(ROOT, "src"))
+os.environ.setdefault("MIDDLEWARE_REDIS_DB", BENCHMARK_DB)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def summarize(samples):
+    """
+    Summarize latency samples, given in seconds, in microseconds.
+    """
+    return {
+        "mean_us": 1e6 * sum(samples) / len(samples),
+        "p50_us": 1e6 * percentile(samples, 50),
+        "p99_us": 1e6 * percentile(samples, 99),
+        "samples": len(samples),
+    }
+
+
+def time_calls(fn, iterations):
+    """
+    Call fn iterations times and summarize the latency of each call.
+    """
+    samples = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return summarize(samples)
+
+
+def metadata():
+    """
+    Describe where the results come from, so results from different branches can be compared.
+    """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "env": {k: v for k, v in os.environ.items() if k.startswith("MIDDLEWARE_")},
+    }
+
+
+def write_results(results, path=None):
+    """
+    Print results as json, and also write them to path if given.
+    """
+    text = json.dumps(results, indent=2)
+    print(text)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
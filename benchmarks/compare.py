@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+
+
+"""
+
+Compare two benchmark result files.
+
+Prints every numeric metric found in both files, with the ratio new / old.
+Latencies (_us) are better when the ratio is below 1, rates (_fps) when it is above 1.
+
+usage: python3 compare.py <old.json> <new.json>
+
+"""
+
+
+import json
+import sys
+
+
+def flatten(results, prefix=""):
+    """
+    Flatten nested results into a dictionary of dotted names and numbers.
+    """
+    metrics = {}
+    for k, v in results.items():
+        name = prefix + k
+        if isinstance(v, dict):
+            metrics.update(flatten(v, name + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            metrics[name] = v
+    return metrics
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: python3 compare.py <old.json> <new.json>")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        old = flatten(json.load(f))
+    with open(sys.argv[2]) as f:
+        new = flatten(json.load(f))
+    for name in sorted(set(old) & set(new)):
+        if name.endswith(".samples") or name == "iterations":
+            continue
+        ratio = new[name] / old[name] if old[name] else float("nan")
+        print(f'{name:60s} {old[name]:12.1f} {new[name]:12.1f} {ratio:8.2f}')
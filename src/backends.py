@@ -0,0 +1,787 @@
+#! /usr/bin/env python
+
+
+"""
+
+Middleware backends.
+
+By default the middleware stores its data in redis, through a redis.Redis client.
+This module provides two other backends, which behave like the part of the redis.Redis client the middleware uses:
+
+- local: the data is kept in a dictionary of the current process.
+  For single process runs, tests and benchmarks without a redis server.
+
+- shm: the data is kept in shared memory, one file per key under /dev/shm, so nodes running on the same machine share it
+  without going through a server. Changes are announced through unix datagram sockets, one per subscriber.
+
+Select a backend with the MIDDLEWARE_BACKEND environment variable, see middleware.get_backend().
+
+"""
+
+
+import collections
+import fcntl
+import fnmatch
+import os
+import json
+import queue
+import socket
+import stat
+import struct
+import threading
+import time
+import urllib.parse
+
+import redis
+
+
+# directory of the shared memory backend, one per database
+SHM_PATH = "/dev/shm/elmo_middleware_{db}"
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+# permissions of the files and directories shared by the nodes, driver_leds runs as root, the other nodes do not
+SHARED_FILE_MODE = 0o660
+# new files inherit the group of the directory
+SHARED_DIR_MODE = 0o2770
+
+# channel on which a subscriber of the shm backend is told that messages published to it were dropped,
+# middleware.ChangeFeed then considers every key changed
+LOST_MESSAGES_CHANNEL = "__lost_messages__"
+
+
+def to_bytes(value):
+    """
+    Encode a value the way the redis client does.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, bool):
+        raise redis.DataError("Invalid input of type: 'bool'")
+    if isinstance(value, (int, float)):
+        return repr(value).encode()
+    raise redis.DataError(f"Invalid input of type: '{type(value).__name__}'")
+
+def to_str(key):
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+def flatten(keys, args):
+    """
+    Accept keys as a list or as separate arguments, like the redis client.
+    """
+    keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+    return [to_str(k) for k in keys + list(args)]
+
+
+def share(path):
+    """
+    Give the group of the user that started the process read and write access to path.
+    Under sudo, the group is the one of the user that ran sudo, so root and that user's nodes share path.
+    Only the owner can change path, a path created by another user is left as it is.
+    """
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return
+    if info.st_uid != os.geteuid():
+        return
+    if os.geteuid() == 0 and "SUDO_GID" in os.environ:
+        os.chown(path, -1, int(os.environ["SUDO_GID"]))
+    os.chmod(path, SHARED_DIR_MODE if stat.S_ISDIR(info.st_mode) else SHARED_FILE_MODE)
+
+
+def encode_record(record):
+    """
+    Encode a record of the shm backend as json, bytes are stored as latin-1 strings.
+    Records are shared with other users, so they are never pickled: loading them must not run code.
+    """
+    value, expires = record
+    if isinstance(value, bytes):
+        kind, data = "string", value.decode("latin-1")
+    elif isinstance(value, dict):
+        kind, data = "hash", [[k.decode("latin-1"), v.decode("latin-1")] for k, v in value.items()]
+    elif isinstance(value, set):
+        kind, data = "set", [m.decode("latin-1") for m in value]
+    elif isinstance(value, collections.deque):
+        kind, data = "list", [m.decode("latin-1") for m in value]
+    else:
+        kind, data = "stream", [[ms, seq, [[k.decode("latin-1"), v.decode("latin-1")] for k, v in fields.items()]] for ms, seq, fields in value]
+    return json.dumps([kind, expires, data], separators=(",", ":")).encode()
+
+def decode_record(raw):
+    """
+    Decode a record encoded by encode_record().
+    """
+    kind, expires, data = json.loads(raw)
+    if kind == "string":
+        value = data.encode("latin-1")
+    elif kind == "hash":
+        value = {k.encode("latin-1"): v.encode("latin-1") for k, v in data}
+    elif kind == "set":
+        value = {m.encode("latin-1") for m in data}
+    elif kind == "list":
+        value = collections.deque(m.encode("latin-1") for m in data)
+    elif kind == "stream":
+        value = [(ms, seq, {k.encode("latin-1"): v.encode("latin-1") for k, v in fields}) for ms, seq, fields in data]
+    else:
+        raise ValueError(f'unknown record kind {kind}')
+    return value, expires
+
+# length of the channel, at the start of a message of the shm backend
+MESSAGE_HEADER = struct.Struct("<H")
+
+def encode_message(channel, data):
+    return MESSAGE_HEADER.pack(len(channel)) + channel + data
+
+def decode_message(raw):
+    """
+    Returns the channel and data of a message encoded by encode_message().
+    """
+    size = MESSAGE_HEADER.unpack_from(raw)[0]
+    start = MESSAGE_HEADER.size
+    return raw[start:start + size], raw[start + size:]
+
+
+class DictStore:
+    """
+    DictStore class.
+    Keeps the data in a dictionary of this process.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.RLock()
+        self.subscribers = []
+
+    def load(self, key):
+        return self.data.get(key)
+
+    def save(self, key, record):
+        self.data[key] = record
+
+    def remove(self, key):
+        self.data.pop(key, None)
+
+    def keys(self):
+        return list(self.data)
+
+    def clear(self):
+        self.data.clear()
+
+    def publish(self, channel, data):
+        for subscriber in list(self.subscribers):
+            subscriber.put((channel, data))
+        return len(self.subscribers)
+
+    def subscribe(self):
+        return DictSubscription(self)
+
+
+class DictSubscription:
+    """
+    Messages published to a DictStore, for one subscriber.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.messages = queue.Queue()
+        store.subscribers.append(self)
+
+    def put(self, message):
+        self.messages.put(message)
+
+    def get(self, timeout):
+        try:
+            if timeout is not None and timeout <= 0:
+                return self.messages.get_nowait()
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if self in self.store.subscribers:
+            self.store.subscribers.remove(self)
+
+
+class SharedMemoryLock:
+    """
+    Lock shared by the threads of this process and by other processes, through flock on a lock file.
+    Reentrant, so commands can run inside a locked pipeline.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, SHARED_FILE_MODE)
+        share(self.path)
+
+    def __enter__(self):
+        # flock is shared with the parent after a fork, reopen the lock file
+        if self.pid != os.getpid():
+            self.reset()
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+class SharedMemoryStore:
+    """
+    SharedMemoryStore class.
+    Keeps each key in its own file under path, on a shared memory filesystem.
+    Files are replaced atomically, so keys can be read without taking the lock.
+    Messages are sent to each subscriber's socket without blocking. A subscriber that does not keep up
+    loses messages, and is told so by a .lost file next to its socket, see SocketSubscription.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys_path = os.path.join(path, "keys")
+        self.subscribers_path = os.path.join(path, "subscribers")
+        os.makedirs(self.keys_path, exist_ok=True)
+        os.makedirs(self.subscribers_path, exist_ok=True)
+        for directory in (self.path, self.keys_path, self.subscribers_path):
+            share(directory)
+        self.lock = SharedMemoryLock(os.path.join(path, "lock"))
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.subscriptions = 0
+        # subscriber sockets this process has no permission to send to
+        self.unreachable = set()
+
+    def file(self, key):
+        return os.path.join(self.keys_path, urllib.parse.quote(key, safe=""))
+
+    def load(self, key):
+        try:
+            with open(self.file(key), "rb") as f:
+                return decode_record(f.read())
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, record):
+        path = self.file(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, "wb") as f:
+            f.write(encode_record(record))
+        os.replace(tmp, path)
+
+    def remove(self, key):
+        try:
+            os.unlink(self.file(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self):
+        return [urllib.parse.unquote(name) for name in os.listdir(self.keys_path) if not name.endswith(".tmp")]
+
+    def clear(self):
+        for key in self.keys():
+            self.remove(key)
+
+    def publish(self, channel, data):
+        message = encode_message(channel, data)
+        receivers = 0
+        for name in os.listdir(self.subscribers_path):
+            if name.endswith(".lost"):
+                continue
+            address = os.path.join(self.subscribers_path, name)
+            try:
+                self.sender.sendto(message, address)
+                receivers += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the subscriber is gone
+                try:
+                    os.unlink(address)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # the subscriber is not keeping up, drop the message and tell it
+                self.mark_lost(address)
+            except PermissionError:
+                # a socket not shared with this user, see share()
+                if address not in self.unreachable:
+                    self.unreachable.add(address)
+                    print(f'shm backend: no permission to notify {address}, its changes will be late')
+                self.mark_lost(address)
+        return receivers
+
+    def mark_lost(self, address):
+        try:
+            os.close(os.open(address + ".lost", os.O_WRONLY | os.O_CREAT, SHARED_FILE_MODE))
+        except OSError:
+            pass
+
+    def subscribe(self):
+        self.subscriptions += 1
+        address = os.path.join(self.subscribers_path, f'{os.getpid()}_{threading.get_ident()}_{self.subscriptions}')
+        return SocketSubscription(address)
+
+
+class SocketSubscription:
+    """
+    Messages published to a SharedMemoryStore, received on a unix datagram socket.
+    When publishers dropped messages, the next get() returns a message on LOST_MESSAGES_CHANNEL instead.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.lost_path = address + ".lost"
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        share(address)
+
+    def get(self, timeout):
+        if os.path.exists(self.lost_path):
+            try:
+                os.unlink(self.lost_path)
+            except FileNotFoundError:
+                pass
+            return LOST_MESSAGES_CHANNEL.encode(), b""
+        self.socket.settimeout(timeout)
+        try:
+            return decode_message(self.socket.recv(65536))
+        except (socket.timeout, BlockingIOError):
+            return None
+        except OSError:
+            # closed by close() while waiting
+            return None
+        except struct.error:
+            # not a message of the store
+            return None
+
+    def close(self):
+        self.socket.close()
+        for path in (self.address, self.lost_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class ConnectionPool:
+    """
+    Stands in for the connection pool of a redis client, the middleware only reads its db.
+    """
+
+    def __init__(self, db):
+        self.connection_kwargs = {"db": db}
+
+    def reset(self):
+        pass
+
+
+class LocalConnection:
+    """
+    LocalConnection class.
+    Implements the redis commands used by the middleware on top of a DictStore or a SharedMemoryStore.
+    Every write announces a keyspace notification, as redis does with notify-keyspace-events set to KA.
+    Keys are stored as records of a value and an expiry time: bytes for strings, dict for hashes,
+    set for sets, deque for lists and list for streams.
+    """
+
+    def __init__(self, store, db=0):
+        self.store = store
+        self.db = db
+        self.connection_pool = ConnectionPool(db)
+
+    def read(self, key, kind=None):
+        record = self.store.load(to_str(key))
+        if record is None:
+            return None
+        value, expires = record
+        if expires is not None and expires <= time.time():
+            self.store.remove(to_str(key))
+            return None
+        if kind is not None and not isinstance(value, kind):
+            raise redis.ResponseError(WRONGTYPE)
+        return value
+
+    def write(self, key, value, event, expires=None):
+        self.store.save(to_str(key), (value, expires))
+        self.notify(key, event)
+
+    def notify(self, key, event):
+        self.store.publish(f'__keyspace@{self.db}__:{to_str(key)}'.encode(), event.encode())
+
+    # strings
+
+    def get(self, name):
+        return self.read(name, bytes)
+
+    def set(self, name, value, ex=None, px=None, nx=False):
+        with self.store.lock:
+            if nx and self.read(name) is not None:
+                return None
+            expires = None
+            if ex is not None:
+                expires = time.time() + ex
+            elif px is not None:
+                expires = time.time() + px / 1000.0
+            self.write(name, to_bytes(value), "set", expires)
+            return True
+
+    def mget(self, keys, *args):
+        values = []
+        for key in flatten(keys, args):
+            value = self.read(key)
+            values.append(value if isinstance(value, bytes) else None)
+        return values
+
+    def mset(self, mapping):
+        with self.store.lock:
+            for key, value in mapping.items():
+                self.write(key, to_bytes(value), "set")
+            return True
+
+    def incr(self, name, amount=1):
+        with self.store.lock:
+            try:
+                value = int(self.read(name, bytes) or 0) + amount
+            except ValueError:
+                raise redis.ResponseError("value is not an integer or out of range")
+            self.write(name, str(value).encode(), "incrby")
+            return value
+
+    # keys
+
+    def exists(self, *names):
+        return sum(1 for name in names if self.read(name) is not None)
+
+    def delete(self, *names):
+        with self.store.lock:
+            deleted = 0
+            for name in names:
+                if self.read(name) is not None:
+                    self.store.remove(to_str(name))
+                    self.notify(name, "del")
+                    deleted += 1
+            return deleted
+
+    def scan_iter(self, match=None, count=None):
+        for key in self.store.keys():
+            if (match is None or fnmatch.fnmatchcase(key, to_str(match))) and self.read(key) is not None:
+                yield key.encode()
+
+    def flushdb(self):
+        with self.store.lock:
+            self.store.clear()
+            return True
+
+    # hashes
+
+    def hget(self, name, key):
+        return (self.read(name, dict) or {}).get(to_bytes(key))
+
+    def hmget(self, name, keys, *args):
+        hash = self.read(name, dict) or {}
+        return [hash.get(k.encode()) for k in flatten(keys, args)]
+
+    def hgetall(self, name):
+        return dict(self.read(name, dict) or {})
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        with self.store.lock:
+            items = dict(mapping or {})
+            if key is not None:
+                items[key] = value
+            hash = self.read(name, dict) or {}
+            added = 0
+            for k, v in items.items():
+                added += to_bytes(k) not in hash
+                hash[to_bytes(k)] = to_bytes(v)
+            self.write(name, hash, "hset")
+            return added
+
+    def hdel(self, name, *keys):
+        with self.store.lock:
+            hash = self.read(name, dict)
+            if not hash:
+                return 0
+            removed = [k for k in map(to_bytes, keys) if k in hash]
+            for k in removed:
+                del hash[k]
+            if hash:
+                self.write(name, hash, "hdel")
+            elif removed:
+                self.store.remove(to_str(name))
+                self.notify(name, "hdel")
+            return len(removed)
+
+    def hsetnx(self, name, key, value):
+        with self.store.lock:
+            hash = self.read(name, dict) or {}
+            if to_bytes(key) in hash:
+                return 0
+            hash[to_bytes(key)] = to_bytes(value)
+            self.write(name, hash, "hset")
+            return 1
+
+    def hincrby(self, name, key, amount=1):
+        with self.store.lock:
+            hash = self.read(name, dict) or {}
+            try:
+                value = int(hash.get(to_bytes(key), b"0")) + amount
+            except ValueError:
+                raise redis.ResponseError("hash value is not an integer")
+            hash[to_bytes(key)] = str(value).encode()
+            self.write(name, hash, "hincrby")
+            return value
+
+    # sets
+
+    def sadd(self, name, *values):
+        with self.store.lock:
+            members = self.read(name, set) or set()
+            added = len({to_bytes(v) for v in values} - members)
+            members.update(to_bytes(v) for v in values)
+            self.write(name, members, "sadd")
+            return added
+
+    def srem(self, name, *values):
+        with self.store.lock:
+            members = self.read(name, set)
+            if not members:
+                return 0
+            removed = len(members & {to_bytes(v) for v in values})
+            members.difference_update(to_bytes(v) for v in values)
+            if members:
+                self.write(name, members, "srem")
+            else:
+                self.store.remove(to_str(name))
+                self.notify(name, "srem")
+            return removed
+
+    def smembers(self, name):
+        return set(self.read(name, set) or set())
+
+    # lists, the left end is the head
+
+    def save_list(self, name, items, event):
+        # as in redis, a list that becomes empty is deleted
+        if items:
+            self.write(name, items, event)
+        else:
+            self.store.remove(to_str(name))
+            self.notify(name, event)
+
+    def lpush(self, name, *values):
+        with self.store.lock:
+            items = self.read(name, collections.deque) or collections.deque()
+            items.extendleft(to_bytes(v) for v in values)
+            self.write(name, items, "lpush")
+            return len(items)
+
+    def rpush(self, name, *values):
+        with self.store.lock:
+            items = self.read(name, collections.deque) or collections.deque()
+            items.extend(to_bytes(v) for v in values)
+            self.write(name, items, "rpush")
+            return len(items)
+
+    def rpoplpush(self, src, dst):
+        with self.store.lock:
+            items = self.read(src, collections.deque)
+            if not items:
+                return None
+            value = items.pop()
+            self.save_list(src, items, "rpop")
+            self.lpush(dst, value)
+            return value
+
+    def lrem(self, name, count, value):
+        with self.store.lock:
+            items = self.read(name, collections.deque)
+            if not items:
+                return 0
+            value = to_bytes(value)
+            order = reversed(range(len(items))) if count < 0 else range(len(items))
+            matches = [i for i in order if items[i] == value][:abs(count) or None]
+            for i in sorted(matches, reverse=True):
+                del items[i]
+            if matches:
+                self.save_list(name, items, "lrem")
+            return len(matches)
+
+    def lrange(self, name, start, end):
+        items = list(self.read(name, collections.deque) or [])
+        end = len(items) + end + 1 if end < 0 else end + 1
+        return items[start:end]
+
+    def llen(self, name):
+        return len(self.read(name, collections.deque) or [])
+
+    # streams, entries are stored as (milliseconds, sequence, fields)
+
+    def xadd(self, name, fields, id="*", maxlen=None, approximate=True):
+        with self.store.lock:
+            stream = self.read(name, list) or []
+            ms, seq = int(time.time() * 1000), 0
+            if stream and ms <= stream[-1][0]:
+                ms, seq = stream[-1][0], stream[-1][1] + 1
+            stream.append((ms, seq, {to_bytes(k): to_bytes(v) for k, v in fields.items()}))
+            if maxlen is not None:
+                del stream[:-maxlen]
+            self.write(name, stream, "xadd")
+            return f'{ms}-{seq}'.encode()
+
+    @staticmethod
+    def stream_id(value, last):
+        """
+        Parse a stream id bound. Milliseconds without a sequence cover the whole millisecond.
+        """
+        value = to_str(value)
+        if value == "-":
+            return (0, 0)
+        if value == "+":
+            return (float("inf"), 0)
+        if "-" in value:
+            ms, seq = value.split("-")
+            return (int(ms), int(seq))
+        return (int(value), float("inf") if last else 0)
+
+    def xrange(self, name, min="-", max="+", count=None):
+        low, high = self.stream_id(min, False), self.stream_id(max, True)
+        result = [
+            (f'{ms}-{seq}'.encode(), dict(fields))
+            for ms, seq, fields in self.read(name, list) or []
+            if low <= (ms, seq) <= high
+        ]
+        return result[:count] if count is not None else result
+
+    def xrevrange(self, name, max="+", min="-", count=None):
+        result = self.xrange(name, min, max)[::-1]
+        return result[:count] if count is not None else result
+
+    # pub/sub
+
+    def publish(self, channel, message):
+        return self.store.publish(to_bytes(channel), to_bytes(message))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self.store)
+
+    # server
+
+    def config_get(self, pattern="*"):
+        # keyspace notifications are always on
+        return {"notify-keyspace-events": "AK"}
+
+    def config_set(self, name, value):
+        return True
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+
+class LocalPipeline:
+    """
+    Queues commands and runs them under the store lock on execute(), like a redis MULTI/EXEC transaction.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        command = getattr(self.connection, name)
+        def queue_command(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue_command
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        results = []
+        with self.connection.store.lock:
+            for command, args, kwargs in commands:
+                try:
+                    results.append(command(*args, **kwargs))
+                except redis.ResponseError as e:
+                    results.append(e)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+class LocalPubSub:
+    """
+    Pattern subscriptions to the channels of a store, like a redis.client.PubSub.
+    """
+
+    def __init__(self, store):
+        self.subscription = store.subscribe()
+        self.patterns = {}
+
+    def psubscribe(self, *args, **kwargs):
+        self.patterns.update({to_str(p): None for p in args})
+        self.patterns.update({to_str(p): handler for p, handler in kwargs.items()})
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        """
+        Wait up to timeout seconds for a message on a subscribed pattern.
+        Messages with a handler are passed to it and None is returned, as with redis.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            received = self.subscription.get(remaining)
+            if received is None:
+                return None
+            channel, data = received
+            for pattern, handler in list(self.patterns.items()):
+                if fnmatch.fnmatchcase(channel.decode(), pattern):
+                    message = {"type": "pmessage", "pattern": pattern.encode(), "channel": channel, "data": data}
+                    if handler is None:
+                        return message
+                    handler(message)
+                    return None
+            if remaining == 0.0:
+                return None
+
+    def run_in_thread(self, sleep_time=0.0, daemon=False):
+        thread = PubSubThread(self, sleep_time, daemon)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.subscription.close()
+
+
+class PubSubThread(threading.Thread):
+    """
+    Passes the messages of a LocalPubSub to their handlers, like redis.client.PubSubWorkerThread.
+    """
+
+    def __init__(self, pubsub, sleep_time, daemon):
+        super().__init__(daemon=daemon)
+        self.pubsub = pubsub
+        self.sleep_time = sleep_time
+        self.running = threading.Event()
+
+    def run(self):
+        self.running.set()
+        while self.running.is_set():
+            self.pubsub.get_message(timeout=self.sleep_time)
+
+    def stop(self):
+        self.running.clear()
@@ -8,17 +8,21 @@ Behaviour node.
 When a head touch is detected, the behaviour updates the onboard image,
 plays a sound and changes the leds.
 
+Runs on asyncio, so touches are still watched while blushing.
+
 """
 
 
+import asyncio
 import time
 
 import middleware as mw
+import middleware_aio as aio
 
 
-LOOP_RATE = 10
-TOUCH_COUNTER_THRESHOLD = 3
-COOLDOWN = 5 * LOOP_RATE
+# seconds after a blush during which touches are ignored
+COOLDOWN = 5.0
+HEAD_FIELDS = ("touch_head_0", "touch_head_1", "touch_head_2", "touch_head_3")
 
 
 class BehaviourBlush:
@@ -27,55 +31,72 @@ class BehaviourBlush:
         Connect to middleware.
         Initialize node.
         """
-        self.touch_sensors = mw.TouchSensors()
+        mw.enable_cache()
+        self.touch_sensors = aio.TouchSensors()
         self.leds = mw.Leds()
-        self.onboard = mw.Onboard()
+        self.onboard = aio.Onboard()
         self.speakers = mw.Speakers()
-        self.behaviours = mw.Behaviours()
+        self.behaviours = aio.Behaviours()
         self.server = mw.Server()
         self.node = mw.Node("behaviour_blush")
     
-    def blush(self):
+    async def blush(self):
         """
         Blush routine.
         Updates the onboard image, plays a sound and changes the leds.
         """
         self.node.loginfo("blushing")
         image_url = self.server.url_for_image("love.png")
-        self.onboard.image = image_url
+        await self.onboard.set("image", image_url)
+        # commands are queued through the blocking client, keep them off the event loop
         sound_url = self.server.url_for_sound("love.wav")
-        self.speakers.url = sound_url
+        await asyncio.to_thread(self.speakers.play, sound_url)
         icon_url = self.server.url_for_icon("heartbeat.gif")
-        self.leds.load_from_url(icon_url) 
-        time.sleep(5.0)
+        await asyncio.to_thread(self.leds.show_icon, icon_url)
+        await asyncio.sleep(5.0)
         image_url = self.server.url_for_image("normal.png")
-        self.onboard.image = image_url
+        await self.onboard.set("image", image_url)
         icon_url = self.server.url_for_icon("elmo_idm.png")
-        self.leds.load_from_url(icon_url)
+        await asyncio.to_thread(self.leds.show_icon, icon_url)
+
+    def on_blush_done(self, task):
+        """
+        Log the error of a blush that failed, the task is not awaited.
+        """
+        if not task.cancelled() and task.exception() is not None:
+            self.node.logerror(f'blush failed: {task.exception()!r}')
+
+    async def watch_touches(self):
+        """
+        Blush when a head sensor is touched, unless blushing is disabled or a blush just started.
+        """
+        last_blush = None
+        async for field, touched in aio.watch(self.touch_sensors, *HEAD_FIELDS):
+            if not touched or (last_blush is not None and time.monotonic() - last_blush < COOLDOWN):
+                continue
+            if await self.behaviours.get("blush"):
+                # keep a reference, the event loop only keeps a weak one
+                self.blushing = asyncio.create_task(self.blush())
+                self.blushing.add_done_callback(self.on_blush_done)
+                last_blush = time.monotonic()
 
-    def run(self):
+    async def run(self):
         """
         Main loop.
         """
         try:
             self.node.loginfo("starting behaviour")
-            touch_counter = 0
-            cooldown_counter = 0
-            while not self.node.is_shutdown():
-                time.sleep(1.0 / LOOP_RATE)
-                if cooldown_counter > 0:
-                    cooldown_counter -= 1
-                if self.behaviours.blush and self.touch_sensors.head_touch():
-                    if touch_counter < TOUCH_COUNTER_THRESHOLD:
-                        touch_counter += 1
-                    if touch_counter == TOUCH_COUNTER_THRESHOLD:
-                        if cooldown_counter == 0:
-                            self.blush()
-                            cooldown_counter = COOLDOWN
+            watcher = asyncio.create_task(self.watch_touches())
+            # touches are handled by the watcher as they are published, only wait for a shutdown request here
+            while not self.node.is_shutdown() and not watcher.done():
+                await asyncio.to_thread(self.node.shutdown_requested.wait, 1.0)
+            if watcher.done():
+                watcher.result()
+            watcher.cancel()
         finally:
             self.node.shutdown()
 
 
 if __name__ == '__main__':
     node = BehaviourBlush()
-    node.run()
+    asyncio.run(node.run())
@@ -32,9 +32,11 @@ class ModeManager:
         self.leds = mw.Leds()
         self.behaviours = mw.Behaviours()
         self.server = mw.Server()
-        self.server.wait_for_ready()
         self.gpio = mw.GPIO()
         self.node = mw.Node("behaviour_change_mode")
+        # the supervisor starts the node once the http server is ready, wait for it when started on its own
+        while not self.server.ready and not self.node.is_shutdown():
+            self.node.wait_for_change(self.server, "ready", timeout=1.0)
         self.modes = [
             MODE_IDLE,
             MODE_MUSIC,
@@ -48,7 +50,7 @@ class ModeManager:
         """
         self.node.loginfo("idle mode")
         url = self.server.url_for_icon("elmo_idm.png")
-        self.leds.load_from_url(url)
+        self.leds.show_icon(url)
 
     def music_mode(self):
         """
@@ -56,7 +58,7 @@ class ModeManager:
         """
         self.node.loginfo("music mode")
         url = self.server.url_for_icon("music.png")
-        self.leds.load_from_url(url)
+        self.leds.show_icon(url)
     
     def call_mode(self):
         """
@@ -64,7 +66,7 @@ class ModeManager:
         """
         self.node.loginfo("call mode")
         url = self.server.url_for_icon("call.png")
-        self.leds.load_from_url(url)
+        self.leds.show_icon(url)
     
     def next_mode(self):
         """
@@ -93,6 +95,8 @@ class ModeManager:
             was_pressed = False
             self.next_mode()
             while not self.node.is_shutdown():
+                # driver_gpio samples the button every 100 ms, no need to spin faster
+                self.node.wait_for_change(self.gpio, "button_pressed", timeout=1.0 / LOOP_RATE)
                 if not self.behaviours.change_mode:
                     continue
                 is_pressed = self.gpio.button_pressed
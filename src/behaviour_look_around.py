@@ -26,6 +26,7 @@ class BehaviourLookAround:
         Connect to middleware.
         Initialize node.
         """
+        mw.enable_cache()
         self.node = mw.Node("behaviour_look_around")
         self.behaviours = mw.Behaviours()
         self.pan = mw.Pan()
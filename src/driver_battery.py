@@ -10,6 +10,7 @@ This node reads the battery voltage and publishes it to the middleware.
 """
 
 
+import collections
 import io
 import fcntl
 import time
@@ -20,6 +21,7 @@ import middleware as mw
 
 I2C_SLAVE_COMMAND=0x0703
 THRESHOLD = 14.0
+VOLTAGE_WINDOW = 100
 
 
 def battery_percentage(voltage, a=30.955, b=-412.661, c=21.604, d=-0.935):
@@ -49,7 +51,6 @@ class DriverBattery:
         x = [value_at_13v, value_at_16v]
         y = [130, 160]
         self.slope, self.bias = np.polyfit(x, y, 1)
-        self.voltage_buffer = []
     
     def read_ad(self):
         """
@@ -72,17 +73,17 @@ class DriverBattery:
         """
         try:
             self.battery.ready = True
+            # voltage is only published when it moves, see Battery.write_policies, so the recorded history
+            # holds fewer readings than were taken, average the last 100 readings here instead
+            voltages = collections.deque(maxlen=VOLTAGE_WINDOW)
             while not self.node.is_shutdown():
                 time.sleep(0.1)
                 raw = self.read_ad()
-                self.battery.raw = raw
                 voltage = self.ad_to_voltage(raw)
-                self.battery.voltage = voltage
-                self.voltage_buffer.append(voltage)
-                if len(self.voltage_buffer) > 100:
-                    self.voltage_buffer.pop(0)
-                    m = np.mean(self.voltage_buffer)
-                    self.battery.percentage = battery_percentage(m)
+                self.battery.update(raw=raw, voltage=voltage)
+                voltages.append(voltage)
+                if len(voltages) >= VOLTAGE_WINDOW:
+                    self.battery.percentage = battery_percentage(np.mean(voltages))
         except KeyboardInterrupt:
             pass
         finally:
@@ -66,7 +66,8 @@ class DriverGpio:
         try:
             self.gpio.ready = True
             while not self.node.is_shutdown():
-                time.sleep(0.1)
+                # pins are still sampled every 100 ms, power requests wake the loop immediately
+                self.node.wait_for_change(self.gpio, "audio_enable", "monitor_enable", timeout=0.1)
                 if self.gpio.audio_enable and not self.gpio.audio_enabled:
                     self.enable_audio(True)
                     self.gpio.audio_enabled = True
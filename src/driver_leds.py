@@ -12,7 +12,8 @@ Uses the neopixel library to control the leds.
 """
 
 
-import time
+import threading
+
 import board
 import neopixel
 
@@ -30,28 +31,46 @@ class DriverLeds:
         """
         self.node = mw.Node("driver_leds")
         self.leds = mw.Leds()
-        self.colors = [[0, 0, 0]] * self.leds.number
+        self.sequence = None
         self.pixels = neopixel.NeoPixel(board.D18, self.leds.number, brightness=self.leds.brightness, auto_write=False)
         print("brightness: %s, %s" % (self.leds.brightness, type(self.leds.brightness)))
     
+    def load_icons(self):
+        """
+        Icon loop.
+        Loads the icons queued with Leds.show_icon(), their frames reach the main loop through the ring.
+        """
+        icons = self.leds.commands()
+        # commands left by a previous run that crashed
+        icons.recover()
+        while not self.node.shutdown_requested.is_set():
+            command = self.node.wait_for_command(icons, timeout=1.0)
+            if command is None:
+                continue
+            try:
+                self.leds.load_from_url(command.args["url"])
+                icons.ack(command)
+            except Exception as e:
+                icons.ack(command, error=str(e))
+
     def run(self):
         """
         Main loop.
         """
         try:
             self.leds.ready = True
+            threading.Thread(target=self.load_icons, daemon=True).start()
+            # frames arrive through shared memory, the ring wakes this loop up when one is written
+            frames = self.leds.frames()
             while not self.node.is_shutdown():
-                time.sleep(0.1)
-                colors = self.leds.colors[:]
-                if colors != self.colors:
+                frames.wait(self.sequence, timeout=1.0)
+                sequence, frame = frames.read()
+                if sequence != self.sequence:
                     # print("writing")
                     for i in range(self.leds.number):
-                        r = max(0, min(255, int(colors[i][0])))
-                        g = max(0, min(255, int(colors[i][1])))
-                        b = max(0, min(255, int(colors[i][2])))
-                        self.pixels[i] = [r, g, b]
+                        self.pixels[i] = tuple(frame[3 * i:3 * i + 3])
                     self.pixels.show()
-                    self.colors = colors
+                    self.sequence = sequence
         except KeyboardInterrupt:
             pass
         finally:
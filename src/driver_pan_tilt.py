@@ -25,6 +25,7 @@ class DriverPanTilt:
         Connect to middleware.
         Initialize node.
         """
+        mw.enable_cache()
         self.pan = mw.Pan()
         self.tilt = mw.Tilt()
         self.node = mw.Node("driver_pan_tilt")
@@ -20,6 +20,10 @@ import time
 import middleware as mw
 
 
+# seconds after which the battery percentage is considered stale, the battery driver refreshes it every 30 s at most
+BATTERY_MAX_AGE = 60.0
+
+
 class DriverPower:
 
     def __init__(self):
@@ -59,8 +63,8 @@ class DriverPower:
                 if self.power.gpio_shutdown and self.gpio.robot_shutdown:
                     self.shutdown()
                     break
-                # battery at 0%
-                if self.power.battery_shutdown and self.battery.percentage <= 0:
+                # battery at 0%, as long as the battery driver is still publishing it
+                if self.power.battery_shutdown and self.battery.percentage <= 0 and self.battery.is_fresh("percentage", BATTERY_MAX_AGE):
                     self.shutdown()
                     break
         except KeyboardInterrupt:
@@ -12,8 +12,7 @@ Uses the aplay command to play sounds.
 """
 
 import os
-import multiprocessing
-import time
+import subprocess
 import middleware as mw
 
 
@@ -26,20 +25,21 @@ class DriverSpeakers:
         Initialize node.
         """
         self.speakers = mw.Speakers()
+        self.commands = self.speakers.commands()
         self.volume = 0
         self.node = mw.Node("driver_speakers")
         self.process = None
+        # play commands taken from the queue, the first one is playing
+        self.playlist = []
 
     def play_sound(self, url):
         """
-        Play a sound.
+        Start playing a sound, in the background.
         """
         self.speakers.playing = url
         print(f'playing {url}')
-        os.system(f'/usr/bin/curl {url} | /usr/bin/aplay')
-        self.speakers.url = None
-        self.speakers.playing = None
-    
+        self.process = subprocess.Popen(f'/usr/bin/curl {url} | /usr/bin/aplay', shell=True)
+
     def stop_sound(self):
         """
         Stop playing a sound, by killing the aplay process.
@@ -47,32 +47,54 @@ class DriverSpeakers:
         print(f'stopping')
         os.system("/usr/bin/killall aplay")
 
+    def stop_all(self):
+        """
+        Stop the sound playing and drop the sounds queued after it.
+        """
+        if self.playlist:
+            self.stop_sound()
+            self.process.wait()
+            for command in self.playlist:
+                self.commands.ack(command, "stopped")
+            self.playlist = []
+            self.speakers.playing = None
+
     def run(self):
         """
         Main loop.
         """
         try:
             self.speakers.ready = True
+            # commands left by a previous run that crashed
+            self.commands.recover()
             while not self.node.is_shutdown():
-                time.sleep(0.1)
-                url = self.speakers.url
-                playing = self.speakers.playing
-                volume = self.speakers.volume
-                # play sound
-                if url != playing:
-                    self.stop_sound()
-                    self.process = multiprocessing.Process(target=self.play_sound, args=(url,))
-                    self.process.start()
-                # stop sound
-                if playing and url is None:
-                    self.stop_sound()
-                    self.speakers.playing = None
+                # while a sound plays, wake up regularly to notice it ended
+                timeout = 0.1 if self.playlist else 1.0
+                command = self.node.wait_for_command(self.commands, self.speakers, "volume", timeout=timeout)
+                if command is not None and command.op == "play":
+                    self.playlist.append(command)
+                    if len(self.playlist) == 1:
+                        self.play_sound(command.args["url"])
+                elif command is not None and command.op == "stop":
+                    self.stop_all()
+                    self.commands.ack(command)
+                # next sound
+                if self.playlist and self.process.poll() is not None:
+                    if self.process.returncode == 0:
+                        self.commands.ack(self.playlist.pop(0))
+                    else:
+                        self.commands.ack(self.playlist.pop(0), error=f'playback exited with {self.process.returncode}')
+                    if self.playlist:
+                        self.play_sound(self.playlist[0].args["url"])
+                    else:
+                        self.speakers.playing = None
                 # change volume
+                volume = self.speakers.volume
                 if self.volume != volume:
                     if 0 == os.system(f'/usr/bin/amixer sset "Master" {volume}%'):
                         self.volume = volume
         finally:
-            self.stop_sound()
+            self.stop_all()
             self.node.shutdown()
 
 
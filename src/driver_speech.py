@@ -17,7 +17,6 @@ Internet connection is required.
 
 
 import os
-import time
 
 import middleware as mw
 
@@ -29,16 +28,16 @@ class DriverSpeech:
         Initialize node.
         """
         self.speech = mw.Speech()
+        self.commands = self.speech.commands()
         self.node = mw.Node("driver_speech")
     
     def speak(self, language, text):
         """
         Speak a text.
+        Returns the exit status of the command.
         """
         command = '/usr/bin/rm -f /tmp/f.mp3 /tmp/f.wav && /home/idmind/.local/bin/gtts-cli -l %s "%s" --output /tmp/f.mp3 && /usr/bin/ffmpeg -i /tmp/f.mp3 /tmp/f.wav && /usr/bin/aplay /tmp/f.wav && /usr/bin/rm -f /tmp/f.mp3 /tmp/f.wav' % (language, text)
-        os.system(command)
-        self.speech.saying = ""
-        self.speech.say = ""    
+        return os.system(command)
 
     def run(self):
         """
@@ -46,11 +45,20 @@ class DriverSpeech:
         """
         try:
             self.speech.ready = True
+            # commands left by a previous run that crashed
+            self.commands.recover()
             while not self.node.is_shutdown():
-                time.sleep(0.1)
-                if self.speech.saying != self.speech.say:
-                    self.speech.saying = self.speech.say
-                    self.speak(self.speech.language, self.speech.say)
+                command = self.node.wait_for_command(self.commands, timeout=1.0)
+                if command is None:
+                    continue
+                text = command.args["text"]
+                self.speech.saying = text
+                status = self.speak(self.speech.language, text)
+                self.speech.saying = ""
+                if status == 0:
+                    self.commands.ack(command)
+                else:
+                    self.commands.ack(command, error=f'speech command exited with {status}')
         except KeyboardInterrupt:
             pass
         finally:
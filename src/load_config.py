@@ -3,30 +3,174 @@
 
 """
 
-Load initial middleware keys and values into redis.
+Load the configuration into the middleware.
+
+The configuration is made of layers, json files applied in order, each overriding the keys of the previous ones:
+cfg/initial.json, then the robot's own /home/idmind/elmo.json if it exists, then any file given on the command line.
+All layers are written in a single MULTI/EXEC, nodes see every changed field at once.
+
+Keys that belong to a middleware entry, such as pan_pid_p, are written through the entry,
+so they end up in the right place for the configured storage layout.
+The value of each key and the layer it came from are kept in the middleware.CONFIG_KEY hash.
+
+With --watch, the loader keeps running as the config_loader node, and writes the keys that change
+whenever one of the files is saved, so nodes pick up new values without a restart.
+
+usage: python3 load_config.py [--watch] [config.json ...]
+       python3 load_config.py sources
 
 """
 
 
 import json
 import os
-import redis
+import sys
+import time
+
+import middleware as mw
+
+
+LAYERS = [
+    os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cfg", "initial.json")),
+    "/home/idmind/elmo.json",
+]
+
+# seconds between checks of the files, in watch mode
+WATCH_PERIOD = 1.0
+
+
+def read_layers(paths):
+    """
+    Read and merge the layers, later ones override earlier ones, missing files are skipped.
+    Returns a dictionary of keys with their value and the path of the layer it came from.
+    """
+    config = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            layer = json.load(f)
+        for key, value in layer.items():
+            # redis_* keys configure the middleware connection itself, see middleware.get_connection_config()
+            if not key.startswith("redis_"):
+                config[key] = (value, path)
+    return config
+
+def read_loaded():
+    """
+    Read the configuration last loaded, as returned by read_layers().
+    """
+    loaded = {}
+    for key, raw in mw.connection.hgetall(mw.CONFIG_KEY).items():
+        source = json.loads(raw)
+        loaded[key.decode()] = (source["value"], source["layer"])
+    return loaded
+
+def apply(config, loaded=None, seed=False):
+    """
+    Write the keys of config whose value differs from loaded, all in a single MULTI/EXEC.
+    Keys of loaded that are no longer in config go back to their default value.
+    With seed, the defaults of every entry are stored first, so nodes never find a field missing.
+    Returns the changed keys.
+    """
+    loaded = loaded or {}
+    changed = [k for k, (v, path) in config.items() if k not in loaded or loaded[k][0] != v]
+    removed = [k for k in loaded if k not in config]
+    transaction = mw.Transaction()
+    pipe = mw.connection.pipeline()
+    if seed:
+        mw.queue_defaults(pipe, mw.entries.values())
+    for key in changed + removed:
+        found = mw.find_field(key)
+        if found is None and key in config:
+            pipe.set(key, json.dumps(config[key][0]))
+            mw.register_keys(pipe, [key])
+        elif found is None:
+            pipe.delete(key)
+        else:
+            entry, field = found
+            transaction.add(entry(), {field: config[key][0] if key in config else entry.fields[field]})
+    if transaction.writes:
+        transaction.queue(pipe)
+    if changed:
+        pipe.hset(mw.CONFIG_KEY, mapping={k: json.dumps({"value": config[k][0], "layer": config[k][1]}) for k in changed})
+    if removed:
+        pipe.hdel(mw.CONFIG_KEY, *removed)
+    if len(pipe):
+        pipe.execute()
+    return changed + removed
+
+def load(*paths):
+    """
+    Load the layers, and any extra files, over the defaults.
+    Returns the changed keys.
+    """
+    return apply(read_layers(LAYERS + list(paths)), read_loaded(), seed=True)
+
+
+class ConfigLoader:
+
+    def __init__(self, paths=()):
+        """
+        Connect to middleware.
+        Initialize node.
+        """
+        self.paths = LAYERS + list(paths)
+        self.node = mw.Node("config_loader")
 
+    def modified(self):
+        return {p: os.stat(p).st_mtime for p in self.paths if os.path.exists(p)}
 
-client = redis.Redis()
+    def reload(self):
+        """
+        Write the keys that changed in the files since they were last loaded.
+        Keys changed at runtime by other nodes are left alone unless their value in the files changed.
+        """
+        try:
+            config = read_layers(self.paths)
+        except ValueError as e:
+            # a file being saved can be read half written, it is read again on its next change
+            self.node.logwarn(f'invalid config: {e}')
+            return
+        for key in apply(config, read_loaded()):
+            if key in config:
+                self.node.loginfo(f'{key} = {json.dumps(config[key][0])} ({config[key][1]})')
+            else:
+                self.node.loginfo(f'{key} back to its default')
 
+    def run(self):
+        """
+        Main loop.
+        """
+        try:
+            modified = self.modified()
+            # files changed while the loader was not running
+            self.reload()
+            while not self.node.is_shutdown():
+                time.sleep(WATCH_PERIOD)
+                current = self.modified()
+                if current != modified:
+                    modified = current
+                    self.reload()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.node.shutdown()
 
-# Load initial config.
-with open("../cfg/initial.json") as f:
-    config = json.load(f)
 
-for key, value in config.items():
-    client.set(key, json.dumps(value))
+def print_sources():
+    """
+    Print each configuration key with its value and the layer it came from.
+    """
+    for key, (value, path) in sorted(read_loaded().items()):
+        print(f'{key:30s} {json.dumps(value):30s} {path}')
 
-# Load custom robot config.
-if "elmo.json" in os.listdir("/home/idmind"):
-    with open("/home/idmind/elmo.json") as f:
-        config = json.load(f)
 
-    for key, value in config.items():
-        client.set(key, json.dumps(value))
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if args == ["sources"]:
+        print_sources()
+    elif "--watch" in sys.argv:
+        ConfigLoader(args).run()
+    else:
+        load(*args)
@@ -19,6 +19,25 @@ Clients can use the Node class to signal that they are running, and check for sh
 
 The NodeManager class can be used to list, shutdown or kill all nodes.
 
+Nodes can watch fields for changes instead of polling them, see Node.watch() and Node.wait_for_change().
+Changes are delivered by redis keyspace notifications, through the ChangeFeed class.
+
+Fields are stored in one key each, named <prefix>_<field>.
+Set the MIDDLEWARE_STORAGE environment variable to "hash" to store each entry in one hash instead,
+and run "python3 middleware.py migrate" once to move existing keys into their hashes.
+
+Set the MIDDLEWARE_STATS environment variable to 1, or call enable_stats(), to count reads, writes, bytes
+and latency per key and node. Use "python3 middleware.py stats" to see the top talkers.
+
+Processes that read the same fields over and over can call enable_cache() to keep the fields
+listed in each DBEntry cached_fields in memory, see the FieldCache class.
+
+Data is stored in redis by default. Set the MIDDLEWARE_BACKEND environment variable to "local" to keep it
+in a dictionary of the current process, or to "shm" to share it between processes through shared memory, see backends.py.
+
+Dependencies that only some nodes need, such as requests, PIL and psutil, are imported by the functions that use them,
+to keep node startup fast.
+
 When used as a script, the module provides a command line interface to manage nodes.
 
 """
@@ -28,37 +47,658 @@ import redis
 import json
 import os
 import signal
-import psutil
 import time
 import sys
-import requests
-from io import BytesIO
-from PIL import Image
 import threading
+import copy
+import fnmatch
+import bisect
+import contextlib
+import fcntl
+import mmap
+import socket
+import struct
+
+
+
+# connection settings, see get_connection_config()
+CONNECTION_DEFAULTS = {
+    "host": "localhost",
+    "port": 6379,
+    "db": 0,
+    "unix_socket": None,
+    "pool_size": 32,
+    "timeout": None,
+    "connect_timeout": 5.0,
+    "keepalive": True,
+    "per_thread": False,
+}
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cfg", "initial.json")
+
+
+def get_connection_config():
+    """
+    Get the connection settings.
+    Read from the redis_* keys of cfg/initial.json, and overridden by MIDDLEWARE_REDIS_* environment variables,
+    for example MIDDLEWARE_REDIS_UNIX_SOCKET=/var/run/redis/redis-server.sock.
+    """
+    config = dict(CONNECTION_DEFAULTS)
+    try:
+        with open(CONFIG_PATH) as f:
+            stored = json.load(f)
+        config.update({k[6:]: v for k, v in stored.items() if k.startswith("redis_") and k[6:] in config})
+    except (OSError, ValueError):
+        pass
+    for k in config:
+        value = os.environ.get("MIDDLEWARE_REDIS_" + k.upper())
+        if value is not None:
+            try:
+                config[k] = json.loads(value)
+            except ValueError:
+                config[k] = value
+    return config
 
+def get_connection(**overrides):
+    """
+    Get a connection to the redis database.
+    Uses the unix domain socket if one is configured, and tcp otherwise.
+    Keyword arguments override the settings from get_connection_config().
+    """
+    config = get_connection_config()
+    config.update(overrides)
+    if config["unix_socket"]:
+        pool = redis.BlockingConnectionPool(
+            connection_class=redis.UnixDomainSocketConnection,
+            path=config["unix_socket"],
+            db=config["db"],
+            max_connections=config["pool_size"],
+            socket_timeout=config["timeout"],
+            socket_connect_timeout=config["connect_timeout"],
+        )
+    else:
+        pool = redis.BlockingConnectionPool(
+            host=config["host"],
+            port=config["port"],
+            db=config["db"],
+            max_connections=config["pool_size"],
+            socket_timeout=config["timeout"],
+            socket_connect_timeout=config["connect_timeout"],
+            socket_keepalive=config["keepalive"],
+        )
+    if config["per_thread"]:
+        return ThreadConnection(pool)
+    return redis.Redis(connection_pool=pool)
+
+
+class ThreadConnection:
+    """
+    ThreadConnection class.
+    Gives each thread its own dedicated connection, taken from a shared pool.
+    Saves a pool checkout per command, at the cost of one connection per thread.
+    Behaves like a redis.Redis client.
+    """
+
+    def __init__(self, pool):
+        self.connection_pool = pool
+        self.local = threading.local()
+
+    def client(self):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = redis.Redis(connection_pool=self.connection_pool, single_connection_client=True)
+            self.local.client = client
+        return client
+
+    def __getattr__(self, name):
+        return getattr(self.client(), name)
 
 
-def get_connection():
+# backend that stores the middleware data, see get_backend()
+BACKEND = os.environ.get("MIDDLEWARE_BACKEND", "redis")
+
+def get_backend(name=BACKEND):
     """
-    Get a connection to the redis database.
+    Get a connection to the backend that stores the middleware data.
+    name is "redis", "local" for a dictionary in this process, or "shm" for shared memory, see backends.py.
     """
-    return redis.Redis()
+    if name == "redis":
+        return get_connection()
+    import backends
+    db = get_connection_config()["db"]
+    if name == "local":
+        return backends.LocalConnection(backends.DictStore(), db)
+    if name == "shm":
+        return backends.LocalConnection(backends.SharedMemoryStore(backends.SHM_PATH.format(db=db)), db)
+    raise ValueError(f'unknown middleware backend {name}')
+
 
 # global connection
-connection = get_connection()
+connection = get_backend()
+
+# keyspace events used by the change feed, K for keyspace channels and A for all commands
+NOTIFY_KEYSPACE_EVENTS = "KA"
+
+# storage layout of entry fields, "keys" for one key per field or "hash" for one hash per entry
+STORAGE = os.environ.get("MIDDLEWARE_STORAGE", "keys")
+
+# entry classes by prefix, filled in as DBEntry subclasses are defined
+entries = {}
+
+# redis sets listing the running nodes and the keys written through the middleware
+NODES_KEY = "registry_nodes"
+KEYS_KEY = "registry_keys"
+# hash of the configuration keys loaded by load_config.py, with their value and the file they came from
+CONFIG_KEY = "registry_config"
+
+# keys this process already added to the key registry
+registered_keys = set()
+# set when this process sees the database emptied, until find_keys() rebuilt the key registry with a SCAN
+registry_reset = threading.Event()
+
+# name stamped on the fields written by each thread, see set_writer()
+_writers = threading.local()
+default_writer = f'pid_{os.getpid()}'
+
+
+def get_db():
+    """
+    Index of the redis database used by the connection.
+    """
+    return connection.connection_pool.connection_kwargs.get("db", 0)
+
+def field_channel(key):
+    """
+    Channel where changes to a field stored in a hash are announced.
+    Hash writes only produce a keyspace notification for the whole hash.
+    """
+    return f'__field@{get_db()}__:{key}'
+
+
+def set_writer(name):
+    """
+    Stamp the fields written by the calling thread with name, Node() sets it to the node name.
+    The first name set also becomes the default for other threads.
+    """
+    global default_writer
+    _writers.name = name
+    if default_writer.startswith("pid_"):
+        default_writer = name
+
+def get_writer():
+    return getattr(_writers, "name", default_writer)
+
+def written_key(prefix):
+    """
+    Name of the hash holding, per field of the entry with prefix, when it was last written and by whom.
+    """
+    return "written_" + prefix
+
+def read_write_times(pairs):
+    """
+    Read when, and by whom, the (entry, field) pairs were last written, in a single round trip.
+    Times are time.monotonic() seconds, comparable between processes of the same boot only.
+    Returns a dictionary keyed by entry.key(field) of (time, writer) tuples, without the fields never written.
+    """
+    groups = {}
+    for e, f in pairs:
+        groups.setdefault(e.prefix, (e, []))[1].append(f)
+    pipe = connection.pipeline(transaction=False)
+    for e, fields in groups.values():
+        pipe.hmget(written_key(e.prefix), fields)
+    result = {}
+    for (e, fields), stamps in zip(groups.values(), pipe.execute()):
+        for f, stamp in zip(fields, stamps):
+            if stamp is not None:
+                t, writer = json.loads(stamp)
+                result[e.key(f)] = (t, writer)
+    return result
+
+def read_ages(pairs):
+    """
+    Seconds since each of the (entry, field) pairs was last written, None for fields never written.
+    Returns a dictionary keyed by entry.key(field).
+    """
+    times = read_write_times(pairs)
+    now = time.monotonic()
+    return {e.key(f): now - times[e.key(f)][0] if e.key(f) in times else None for e, f in pairs}
+
+def register_keys(pipe, keys):
+    """
+    Add keys to the key registry, as part of pipe.
+    Each process registers a key only once, until delete_all() announces a reset, see registry_reset_channel().
+    """
+    new = [k for k in keys if k not in registered_keys]
+    if new:
+        pipe.sadd(KEYS_KEY, *new)
+        registered_keys.update(new)
+
+def registry_reset_channel():
+    """
+    Channel where delete_all() announces that the database, and with it the key registry, was emptied.
+    """
+    return f'__reset@{get_db()}__'
+
+def delete_keys(*keys):
+    """
+    Delete keys from the redis database and from the key registry.
+    """
+    pipe = connection.pipeline(transaction=False)
+    pipe.delete(*keys)
+    pipe.srem(KEYS_KEY, *keys)
+    pipe.execute()
+    registered_keys.difference_update(keys)
 
+def record(op, keys, payloads, start):
+    """
+    Record an operation on keys in the stats, if they are enabled.
+    payloads are the raw values moved for each key, start is the time.perf_counter() before the round trip.
+    """
+    if stats is not None:
+        stats.record(op, keys, [len(p) if p is not None else 0 for p in payloads], time.perf_counter() - start)
 
 def set_key(key, value):
     """
     Set a key in the redis database.
     """
-    connection.set(key, json.dumps(value))
+    start = time.perf_counter()
+    payload = json.dumps(value)
+    pipe = connection.pipeline(transaction=False)
+    pipe.set(key, payload)
+    register_keys(pipe, [key])
+    pipe.execute()
+    record("writes", [key], [payload], start)
 
 def get_key(key):
     """
     Get a key from the redis database.
     """
-    return json.loads(connection.get(key))
+    start = time.perf_counter()
+    raw = connection.get(key)
+    record("reads", [key], [raw], start)
+    return json.loads(raw)
+
+def set_keys(values):
+    """
+    Set several keys in the redis database, atomically.
+    values is a dictionary of keys and values.
+    """
+    if values:
+        start = time.perf_counter()
+        payloads = {k: json.dumps(v) for k, v in values.items()}
+        pipe = connection.pipeline(transaction=False)
+        pipe.mset(payloads)
+        register_keys(pipe, values)
+        pipe.execute()
+        record("writes", list(payloads), list(payloads.values()), start)
+
+def get_keys(keys):
+    """
+    Get several keys from the redis database, in a single round trip.
+    Returns a dictionary with the keys that exist.
+    """
+    if not keys:
+        return {}
+    start = time.perf_counter()
+    raw = connection.mget(keys)
+    record("reads", keys, raw, start)
+    return {k: json.loads(v) for k, v in zip(keys, raw) if v is not None}
+
+def read_fields(pairs):
+    """
+    Read fields of several entries in a single round trip.
+    pairs is a list of (entry, field) tuples.
+    Fields that are not set are stored with their default value.
+    Returns a dictionary keyed by entry.key(field).
+    """
+    start = time.perf_counter()
+    pipe = connection.pipeline(transaction=False)
+    pairs = queue_reads(pipe, pairs)
+    raw = [v for reply in pipe.execute() for v in reply]
+    record("reads", [e.key(f) for e, f in pairs], raw, start)
+    values, missing = decode_fields(pairs, raw)
+    if missing:
+        # a missing field usually means the entry was never used, store the defaults of the whole entry
+        seed_defaults(*{e.prefix: e for e, f in missing}.values())
+        values.update({e.key(f): e.fields[f] for e, f in missing})
+    return values
+
+def queue_reads(pipe, pairs):
+    """
+    Add the commands that read the (entry, field) pairs to pipe.
+    Returns the pairs in the order their values are replied, once the replies are concatenated.
+    """
+    if STORAGE == "hash":
+        groups = {}
+        for e, f in pairs:
+            groups.setdefault(e.prefix, (e, []))[1].append(f)
+        for e, fields in groups.values():
+            pipe.hmget(e.prefix, fields)
+        return [(e, f) for e, fields in groups.values() for f in fields]
+    if pairs:
+        pipe.mget([e.key(f) for e, f in pairs])
+    return list(pairs)
+
+def decode_fields(pairs, raw):
+    """
+    Decode the raw values read for the (entry, field) pairs.
+    Returns a dictionary of values keyed by entry.key(field), and the list of pairs that are not set.
+    """
+    values = {e.key(f): e.decode(f, v) for (e, f), v in zip(pairs, raw) if v is not None}
+    missing = [(e, f) for (e, f), v in zip(pairs, raw) if v is None]
+    return values, missing
+
+def seed_defaults(*entries_to_seed):
+    """
+    Store the default values of all fields of the given entries, or of all entries, in a single round trip.
+    Fields that are already set keep their values.
+    """
+    pipe = connection.pipeline(transaction=False)
+    queue_defaults(pipe, entries_to_seed or entries.values())
+    pipe.execute()
+
+def queue_defaults(pipe, entries_to_seed):
+    """
+    Add the commands that store the defaults of entries_to_seed, when not set, to pipe.
+    """
+    for entry in entries_to_seed:
+        if STORAGE == "hash":
+            for f, v in entry.fields.items():
+                pipe.hsetnx(entry.prefix, f, entry.encode(f, v))
+            register_keys(pipe, [entry.prefix])
+        else:
+            for f, v in entry.fields.items():
+                pipe.set(entry.key(f), entry.encode(f, v), nx=True)
+            register_keys(pipe, [entry.key(f) for f in entry.fields])
+
+def write_fields(entry, values, increment=None):
+    """
+    Write several fields of an entry atomically, in a single round trip.
+    values is a dictionary of fields and values.
+    If increment names an integer field, it is incremented in the same transaction and its new value returned.
+    Values suppressed by the write policies of entry are not written.
+    Inside a transaction(), the write is buffered until the transaction commits, and None is returned.
+    """
+    if entry.write_policies:
+        values = write_filter.filter(entry, values)
+    if not values and increment is None:
+        return
+    current = getattr(_transactions, "current", None)
+    if current is not None:
+        current.add(entry, values, increment)
+        return
+    start = time.perf_counter()
+    payloads = {f: entry.encode(f, v) for f, v in values.items()}
+    pipe = connection.pipeline()
+    position = queue_fields(pipe, entry, payloads, increment)
+    replies = pipe.execute()
+    record("writes", [entry.key(f) for f in payloads], list(payloads.values()), start)
+    if entry.write_policies:
+        write_filter.mark_published(entry, values)
+    if increment is not None:
+        return replies[position]
+
+def queue_fields(pipe, entry, payloads, increment=None, announce=True):
+    """
+    Add the commands that write the encoded values in payloads to pipe.
+    With the hash layout, each field is announced on its field channel unless announce is False.
+    Each written field is stamped with the time and the writer, see read_write_times().
+    Returns the position in pipe of the command that increments increment.
+    """
+    position = len(pipe)
+    written = list(payloads) + ([increment] if increment is not None else [])
+    if written:
+        stamp = json.dumps([round(time.monotonic(), 6), get_writer()])
+        pipe.hset(written_key(entry.prefix), mapping={f: stamp for f in written})
+    if STORAGE == "hash":
+        if increment is not None:
+            pipe.hincrby(entry.prefix, increment, 1)
+        if payloads:
+            pipe.hset(entry.prefix, mapping=payloads)
+        if announce:
+            for f in list(payloads) + ([increment] if increment is not None else []):
+                pipe.publish(field_channel(entry.key(f)), "hset")
+        register_keys(pipe, [entry.prefix])
+    else:
+        if increment is not None:
+            pipe.incr(entry.key(increment))
+        if payloads:
+            pipe.mset({entry.key(f): p for f, p in payloads.items()})
+        register_keys(pipe, [entry.key(f) for f in payloads] + ([entry.key(increment)] if increment is not None else []))
+    for f, p in payloads.items():
+        if f in entry.recorded_fields:
+            pipe.xadd(history_key(entry.key(f)), {"v": p}, maxlen=entry.history_length, approximate=True)
+    return position
+
+def transaction_channel():
+    """
+    Channel where the keys written by a transaction are announced, as a json list, in a single message.
+    """
+    return f'__transaction@{get_db()}__'
+
+def message_key(message):
+    """
+    Key of a keyspace notification or field channel message, channels are named <prefix>:<key>.
+    """
+    return message["channel"].decode().split(":", 1)[1]
+
+
+class AnnouncedKeys:
+    """
+    AnnouncedKeys class.
+    Turns the messages of the keyspace, field and transaction channels into the keys they change, each change once.
+    With the keys layout, the keys written by a transaction are announced on the transaction channel,
+    and then again by their own keyspace notifications, which are skipped.
+    Only the keys in keys are tracked, if given.
+    """
+
+    def __init__(self, keys=None):
+        self.keys = keys
+        # keyspace notifications of keys written by a transaction, to skip after its announcement
+        self.announced = {}
+
+    def changed(self, message):
+        """
+        Keys changed by a message, an empty list for the notification of a key already announced.
+        """
+        if message["channel"].decode() == transaction_channel():
+            keys = [k for k in json.loads(message["data"]) if self.keys is None or k in self.keys]
+            if STORAGE != "hash":
+                for key in keys:
+                    self.announced[key] = self.announced.get(key, 0) + 1
+            return keys
+        key = message_key(message)
+        if self.announced.get(key):
+            self.announced[key] -= 1
+            return []
+        return [key]
+
+    def clear(self):
+        """
+        Forget the announced keys, after changes were lost or the database was emptied.
+        """
+        self.announced.clear()
+
+
+class Transaction:
+    """
+    Transaction class.
+    Buffers the fields written by a thread, and commits them in a single MULTI/EXEC.
+    Change feeds see all the fields change at once, from a single message on the transaction channel.
+    Use transaction() to start one.
+    """
+
+    def __init__(self):
+        self.writes = {}
+
+    def add(self, entry, values, increment=None):
+        """
+        Buffer a write, later writes to the same field win.
+        """
+        buffered = self.writes.setdefault(entry.prefix, (entry, {}, []))
+        buffered[1].update(values)
+        if increment is not None:
+            buffered[2].append(increment)
+
+    def keys(self):
+        return [entry.key(f) for entry, values, increments in self.writes.values() for f in list(values) + increments]
+
+    def queue(self, pipe):
+        """
+        Add the commands that write the buffered fields to pipe, which must be a MULTI/EXEC pipeline.
+        Returns the written keys and their encoded values, as a list of tuples.
+        """
+        # the announcement goes first, so feeds receive it before the keyspace notifications of the writes
+        pipe.publish(transaction_channel(), json.dumps(self.keys()))
+        encoded = []
+        for entry, values, increments in self.writes.values():
+            payloads = {f: entry.encode(f, v) for f, v in values.items()}
+            queue_fields(pipe, entry, payloads, announce=False)
+            for increment in increments:
+                queue_fields(pipe, entry, {}, increment, announce=False)
+            encoded += [(entry.key(f), p) for f, p in payloads.items()]
+        return encoded
+
+    def commit(self):
+        if not self.writes:
+            return
+        start = time.perf_counter()
+        pipe = connection.pipeline()
+        encoded = self.queue(pipe)
+        pipe.execute()
+        record("writes", [k for k, p in encoded], [p for k, p in encoded], start)
+        for entry, values, increments in self.writes.values():
+            if entry.write_policies:
+                write_filter.mark_published(entry, values)
+        self.update_cache()
+
+    def update_cache(self):
+        """
+        Store the committed values in the cache of this process, so it reads its own writes.
+        """
+        for entry, values, increments in self.writes.values():
+            for f, v in values.items():
+                if entry.is_cached(f):
+                    cache.put(entry.key(f), v)
+
+
+# transaction in progress in each thread
+_transactions = threading.local()
+
+def in_transaction():
+    """
+    Check if the calling thread is inside a transaction().
+    """
+    return getattr(_transactions, "current", None) is not None
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Write fields atomically, with a single change notification:
+
+        with mw.transaction():
+            pan.update(min_angle=-30, max_angle=30)
+            tilt.min_angle = -10
+
+    Writes are buffered until the block ends, so reads inside it still return the old values.
+    Nothing is written if the block raises. A transaction started inside another one joins it.
+    """
+    current = getattr(_transactions, "current", None)
+    if current is not None:
+        yield current
+        return
+    current = _transactions.current = Transaction()
+    try:
+        yield current
+    finally:
+        _transactions.current = None
+    current.commit()
+
+def history_key(key):
+    """
+    Name of the stream that records the history of key.
+    """
+    return "history_" + key
+
+def read_history(entry, fields, start=None, end=None, last=None):
+    """
+    Read the recorded history of several fields in a single round trip.
+    start and end are unix timestamps, in seconds. If last is given, only the last samples in the range are read.
+    Returns a dictionary of fields, each a tuple of numpy arrays with the timestamps and the values.
+    """
+    import numpy as np
+    start = "-" if start is None else int(start * 1000)
+    end = "+" if end is None else int(end * 1000)
+    pipe = connection.pipeline(transaction=False)
+    for f in fields:
+        if f not in entry.recorded_fields:
+            raise AttributeError(f'{entry.__class__.__name__} does not record {f}')
+        if last is None:
+            pipe.xrange(history_key(entry.key(f)), start, end)
+        else:
+            pipe.xrevrange(history_key(entry.key(f)), end, start, count=last)
+    result = {}
+    for f, samples in zip(fields, pipe.execute()):
+        if last is not None:
+            samples = samples[::-1]
+        times = [int(i.split(b"-")[0]) / 1000.0 for i, sample in samples]
+        values = [entry.decode(f, sample[b"v"]) for i, sample in samples]
+        result[f] = np.array(times), np.array(values)
+    return result
+
+def read_history_after(entry, last_ids):
+    """
+    Read the samples of several fields recorded after the last ones read, in a single round trip.
+    last_ids is a dictionary of fields with the stream id of the last sample read, or a unix timestamp to read from.
+    It is updated with the id of the last sample of each field, pass it again to read only the newer samples.
+    Returns a dictionary of fields, each a tuple of numpy arrays with the timestamps and the values.
+    """
+    import numpy as np
+    pipe = connection.pipeline(transaction=False)
+    for f, last in last_ids.items():
+        if f not in entry.recorded_fields:
+            raise AttributeError(f'{entry.__class__.__name__} does not record {f}')
+        if isinstance(last, (int, float)):
+            start = f'{int(last * 1000)}-0'
+        else:
+            ms, seq = (last.decode() if isinstance(last, bytes) else last).split("-")
+            start = f'{ms}-{int(seq) + 1}'
+        pipe.xrange(history_key(entry.key(f)), start, "+")
+    result = {}
+    for f, samples in zip(list(last_ids), pipe.execute()):
+        if samples:
+            last_ids[f] = samples[-1][0]
+        times = [int(i.split(b"-")[0]) / 1000.0 for i, sample in samples]
+        values = [entry.decode(f, sample[b"v"]) for i, sample in samples]
+        result[f] = np.array(times), np.array(values)
+    return result
+
+def find_field(key):
+    """
+    Find the entry class and field stored in a key named <prefix>_<field>.
+    Returns None if the key does not belong to any entry.
+    """
+    for prefix, cls in entries.items():
+        field = key[len(prefix) + 1:]
+        if key.startswith(prefix + "_") and field in cls.fields:
+            return cls, field
+    return None
+
+def migrate_storage():
+    """
+    Move entry fields stored in their own keys into one hash per entry.
+    Keys that do not belong to an entry are left as they are.
+    """
+    for prefix, cls in entries.items():
+        keys = [f'{prefix}_{f}' for f in cls.fields]
+        found = {f: (k, v) for f, k, v in zip(cls.fields, keys, connection.mget(keys)) if v is not None}
+        if found:
+            pipe = connection.pipeline()
+            pipe.hset(prefix, mapping={f: v for f, (k, v) in found.items()})
+            pipe.delete(*[k for k, v in found.values()])
+            pipe.srem(KEYS_KEY, *[k for k, v in found.values()])
+            pipe.sadd(KEYS_KEY, prefix)
+            pipe.execute()
 
 def has_key(key):
     """
@@ -66,41 +706,680 @@ def has_key(key):
     """
     return connection.exists(key) != 0
 
+def find_keys(pattern="*"):
+    """
+    List keys matching a glob style pattern.
+    Uses the key registry. When the registry is missing, or after a reset, the registry can miss the keys
+    of processes that keep writing, an incremental SCAN lists the keys instead and adds them back to the registry.
+    Unlike KEYS, neither blocks the database for other clients.
+    """
+    keys = [m.decode() for m in connection.smembers(KEYS_KEY)]
+    if not keys or registry_reset.is_set():
+        registry_reset.clear()
+        scanned = [k.decode() for k in connection.scan_iter(count=1000)]
+        missing = [k for k in scanned if not is_internal_key(k) and k not in keys]
+        if missing:
+            connection.sadd(KEYS_KEY, *missing)
+        keys = sorted(set(keys) | set(missing))
+    return [k for k in keys if fnmatch.fnmatchcase(k, pattern)]
+
+def is_internal_key(key):
+    """
+    Check if key holds middleware bookkeeping, such as the registries or the stats, rather than a field.
+    """
+    return key in (KEYS_KEY, NODES_KEY, STATS_KEY, CONFIG_KEY) or key.startswith(("stats_", "history_", "heartbeat_", "queue_", "written_"))
+
 def has_any_key(prefix):
     """
     Check if any key with the given prefix exists in the redis database.
     """
-    return len(connection.keys(prefix + "*")) > 0
+    return has_any(prefix + "*")
 
 def delete_all():
     """
     Delete all keys from the redis database.
+    Other databases on the same server are left untouched.
     """
-    connection.flushall()
+    connection.flushdb()
+    registered_keys.clear()
+    registry_reset.set()
+    # other processes register their keys again, see ChangeFeed.on_reset()
+    connection.publish(registry_reset_channel(), "flushdb")
 
 def get_all(*prefixes):
     """
     Get all keys from the redis database.
     Optionally, filter by prefix.
     """
-    for k in sorted(connection.keys()):
-        if len(prefixes) == 0 or any([k.decode().startswith(p) for p in prefixes]):
-            print(f'{k.decode()}:\t{get_key(k.decode())}')
+    keys = find_keys()
+    pipe = connection.pipeline(transaction=False)
+    for k in keys:
+        if STORAGE == "hash" and k in entries:
+            pipe.hgetall(k)
+        else:
+            pipe.get(k)
+    items = []
+    for k, v in zip(keys, pipe.execute(raise_on_error=False)):
+        if isinstance(v, Exception):
+            continue
+        if isinstance(v, dict):
+            items += [(f'{k}_{f.decode()}', decode_value(fv)) for f, fv in v.items()]
+        elif v is not None:
+            items.append((k, decode_value(v)))
+    for k, v in sorted(items):
+        if len(prefixes) == 0 or any([k.startswith(p) for p in prefixes]):
+            print(f'{k}:\t{v}')
+
+def decode_value(raw):
+    """
+    Decode a value for display, values that are not json are shown by their size.
+    """
+    try:
+        return json.loads(raw)
+    except (ValueError, UnicodeDecodeError):
+        return f'<{len(raw)} bytes>'
 
 def has_any(key):
     """
-    Check if any key with the given prefix exists in the redis database.
+    Check if any key matching the given pattern exists in the redis database.
+    """
+    keys = find_keys(key)
+    return len(keys) > 0 and connection.exists(*keys) > 0
+
+def enable_notifications():
+    """
+    Enable keyspace notifications in the redis database.
+    Keeps any notification flags that were already enabled.
+    """
+    current = connection.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+    if isinstance(current, bytes):
+        current = current.decode()
+    flags = set(current) | set(NOTIFY_KEYSPACE_EVENTS)
+    if flags != set(current):
+        connection.config_set("notify-keyspace-events", "".join(sorted(flags)))
+
+
+def stream_changes(*prefixes, tick=1.0):
+    """
+    Yield (time, key, event) for every change to a key starting with one of prefixes, or to any key if none are given.
+    Fields stored in hashes are reported under their <prefix>_<field> names.
+    Yields None after tick seconds without changes.
+    """
+    enable_notifications()
+    keyspace = f'__keyspace@{get_db()}__:'
+    pubsub = connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe(keyspace + "*", field_channel("*"))
+    # with the hash layout, fields written by a transaction are only announced on the transaction channel
+    if STORAGE == "hash":
+        pubsub.psubscribe(transaction_channel())
+    try:
+        while True:
+            message = pubsub.get_message(timeout=tick)
+            if message is None:
+                yield None
+                continue
+            channel = message["channel"].decode()
+            if channel == transaction_channel():
+                now = time.time()
+                for key in json.loads(message["data"]):
+                    if not prefixes or any(key.startswith(p) for p in prefixes):
+                        yield now, key, "multi"
+                continue
+            key = channel.split(":", 1)[1]
+            # hashes are reported per field through their field channels
+            if channel.startswith(keyspace) and STORAGE == "hash" and key in entries:
+                continue
+            if is_internal_key(key):
+                continue
+            if prefixes and not any(key.startswith(p) for p in prefixes):
+                continue
+            yield time.time(), key, message["data"].decode()
+    finally:
+        pubsub.close()
+
+def monitor(*prefixes, values=False, window=5.0):
+    """
+    Print changes as they happen, with the update rate of each key over the last window seconds.
+    With values, also read and print the new value, at the cost of one read per change.
+    """
+    history = {}
+    for change in stream_changes(*prefixes):
+        if change is None:
+            continue
+        t, key, event = change
+        times = history.setdefault(key, [])
+        times.append(t)
+        while times[0] < t - window:
+            times.pop(0)
+        line = f'{time.strftime("%H:%M:%S", time.localtime(t))}.{int(t * 1000) % 1000:03d} {key:40s} {event:8s} {len(times) / window:7.1f}/s'
+        if values and event in ("set", "hset", "incrby", "hincrby"):
+            found = find_field(key)
+            raw = connection.hget(found[0].prefix, found[1]) if STORAGE == "hash" and found else connection.get(key)
+            if raw is not None:
+                line += f' {decode_value(raw)}'
+        print(line)
+
+def monitor_rates(*prefixes, period=1.0, top=20):
+    """
+    Print the keys with the most updates per second every period seconds, to find chatty writers.
+    """
+    counts = {}
+    start = time.time()
+    for change in stream_changes(*prefixes, tick=period):
+        if change is not None:
+            counts[change[1]] = counts.get(change[1], 0) + 1
+        now = time.time()
+        if now - start >= period:
+            print_rates(counts, now - start, top)
+            counts, start = {}, now
+
+def print_rates(counts, elapsed, top):
+    """
+    Print update counts as rates, busiest keys first.
+    """
+    print(f'--- {time.strftime("%H:%M:%S")} {sum(counts.values()) / elapsed:.1f} updates/s')
+    for key, n in sorted(counts.items(), key=lambda kv: -kv[1])[:top]:
+        print(f'{key:40s} {n / elapsed:8.1f}/s')
+
+
+class ChangeFeed:
+    """
+    ChangeFeed class.
+    Listens to keyspace notifications in a background thread and keeps a version counter per key.
+    Fields stored in hashes are tracked through their field channels, under the same <prefix>_<field> names.
+    Use get_change_feed() to get the instance shared by the process.
+    Use add_callback() to be called when a key changes.
+    Use wait() to block until one of a set of keys changes.
+    """
+
+    def __init__(self):
+        self.versions = {}
+        self.callbacks = {}
+        self.condition = threading.Condition()
+        enable_notifications()
+        self.pubsub = connection.pubsub(ignore_subscribe_messages=True)
+        self.announced = AnnouncedKeys()
+        handlers = {
+            f'__keyspace@{get_db()}__:*': self.on_message,
+            field_channel("*"): self.on_message,
+            transaction_channel(): self.on_message,
+            registry_reset_channel(): self.on_reset,
+        }
+        if BACKEND == "shm":
+            import backends
+            handlers[backends.LOST_MESSAGES_CHANNEL] = self.on_lost
+        self.pubsub.psubscribe(**handlers)
+        self.thread = self.pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def on_message(self, message):
+        keys = self.announced.changed(message)
+        if keys:
+            self.changed(keys)
+
+    def on_reset(self, message):
+        # every key is gone, keys are registered again on their next write
+        registered_keys.clear()
+        registry_reset.set()
+        self.announced.clear()
+        self.changed(list(set(self.versions) | set(self.callbacks)))
+
+    def on_lost(self, message):
+        # changes were dropped on the way, any key may have changed
+        self.announced.clear()
+        self.changed(list(set(self.versions) | set(self.callbacks)))
+
+    def changed(self, keys):
+        with self.condition:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+            self.condition.notify_all()
+        for key in keys:
+            for callback in list(self.callbacks.get(key, [])):
+                try:
+                    callback(key)
+                except Exception as e:
+                    print(f'change feed: callback for {key} failed: {e}')
+
+    def add_callback(self, key, callback):
+        """
+        Call callback(key) from the feed thread whenever key changes.
+        """
+        self.callbacks.setdefault(key, []).append(callback)
+
+    def remove_callback(self, key, callback):
+        if callback in self.callbacks.get(key, []):
+            self.callbacks[key].remove(callback)
+
+    def version(self, key):
+        """
+        Number of changes seen for key since the feed started.
+        """
+        return self.versions.get(key, 0)
+
+    def wait(self, seen, timeout=None):
+        """
+        Block until a key in seen changes past the version recorded for it.
+        seen maps keys to versions and is updated in place.
+        Keys recorded with version None count as changed.
+        Returns True if a change was observed, False on timeout.
+        """
+        with self.condition:
+            changed = self.condition.wait_for(
+                lambda: any(seen[k] != self.versions.get(k, 0) for k in seen),
+                timeout)
+            for k in seen:
+                seen[k] = self.versions.get(k, 0)
+        return changed
+
+    def close(self):
+        self.thread.stop()
+        self.pubsub.close()
+
+
+class FieldCache:
+    """
+    FieldCache class.
+    Per-process cache of field values, kept valid by the change feed.
+    Only fields listed in the cached_fields attribute of a DBEntry are cached.
+    Use enable_cache() to create it and get_cache_stats() to see how many reads it saved.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self.watched = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        Get the value of key, calling load() to read it from the database on a miss.
+        """
+        return self.get_many([key], lambda keys: {key: load()})[key]
+
+    def get_many(self, keys, load_many):
+        """
+        Get the values of several keys as a dictionary.
+        Misses are read together by calling load_many(missing_keys), which returns a dictionary.
+        """
+        feed = get_change_feed()
+        values = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                if key in self.values:
+                    self.hits += 1
+                    values[key] = copy.deepcopy(self.values[key])
+                else:
+                    self.misses += 1
+                    missing.append(key)
+                    if key not in self.watched:
+                        feed.add_callback(key, self.invalidate)
+                        self.watched.add(key)
+        if missing:
+            # only keep values of keys that did not change while they were being loaded
+            versions = {k: feed.version(k) for k in missing}
+            loaded = load_many(missing)
+            with self.lock:
+                for k in missing:
+                    if feed.version(k) == versions[k]:
+                        self.values[k] = copy.deepcopy(loaded[k])
+            values.update(loaded)
+        return values
+
+    def put(self, key, value):
+        """
+        Store a value written by this process, so it reads its own writes.
+        """
+        with self.lock:
+            if key in self.watched:
+                self.values[key] = copy.deepcopy(value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "size": len(self.values),
+        }
+
+
+# per-process field cache, disabled until enable_cache() is called
+cache = None
+_cache_lock = threading.Lock()
+
+def enable_cache():
+    """
+    Enable the per-process field cache.
+    Nodes hosted by node_runner.py call this from their own threads, and share the same cache.
+    """
+    global cache
+    with _cache_lock:
+        if cache is None:
+            cache = FieldCache()
+        return cache
+
+def get_cache_stats():
+    """
+    Get cache hit and miss counters, or None if the cache is disabled.
+    """
+    if cache is None:
+        return None
+    return cache.stats()
+
+
+class WriteFilter:
+    """
+    WriteFilter class.
+    Applies the write policies of the fields, see DBEntry.write_policies, to the writes of this process.
+    Keeps the last value published for each key and when, and counts the writes it suppressed.
+    The last value is the one this process published, policies are meant for fields with a single writer.
+    Use filter() before a write, and mark_published() once it succeeded, so a failed write or an aborted
+    transaction does not suppress the next writes of the same value.
+    """
+
+    def __init__(self):
+        self.published = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def allows(policy, value, last, elapsed):
+        """
+        Check if a write of value is published under policy, elapsed seconds after last was.
+        """
+        if elapsed >= policy.get("max_interval", float("inf")):
+            return True
+        if "max_rate" in policy and elapsed < 1.0 / policy["max_rate"]:
+            return False
+        if value == last:
+            return not policy.get("skip_equal", "deadband" in policy or "relative_deadband" in policy)
+        numbers = (int, float)
+        if not isinstance(value, numbers) or not isinstance(last, numbers):
+            return True
+        change = abs(value - last)
+        if change <= policy.get("deadband", -1):
+            return False
+        if change <= policy.get("relative_deadband", -1) * abs(last):
+            return False
+        return True
+
+    def filter(self, entry, values):
+        """
+        Returns the values that should be written, dropping the suppressed ones.
+        """
+        now = time.monotonic()
+        result = {}
+        suppressed = []
+        with self.lock:
+            for f, v in values.items():
+                key = entry.key(f)
+                policy = entry.write_policies.get(f)
+                if policy is not None and key in self.published:
+                    last, t = self.published[key]
+                    if not self.allows(policy, v, last, now - t):
+                        suppressed.append(key)
+                        continue
+                result[f] = v
+            for key in suppressed:
+                self.counts[key] = self.counts.get(key, 0) + 1
+        if stats is not None:
+            for key in suppressed:
+                stats.count(key, "suppressed")
+        return result
+
+    def mark_published(self, entry, values):
+        """
+        Record the values of the fields with a write policy as published, once they are written.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for f, v in values.items():
+                if f in entry.write_policies:
+                    self.published[entry.key(f)] = (v, now)
+
+    def forget(self, keys):
+        """
+        Forget the last values published for keys, so their next writes are published.
+        """
+        with self.lock:
+            for key in keys:
+                self.published.pop(key, None)
+
+
+write_filter = WriteFilter()
+
+def get_suppressed_writes():
+    """
+    Number of writes suppressed by the write policies in this process, per key.
+    """
+    with write_filter.lock:
+        return dict(write_filter.counts)
+
+
+# latency histogram buckets of the stats, upper bounds in microseconds
+LATENCY_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+
+# seconds between stats flushes
+STATS_PERIOD = 5.0
+
+# redis set listing the hashes stats are flushed to, one per node
+STATS_KEY = "registry_stats"
+
+
+class Stats:
+    """
+    Stats class.
+    Counts reads, writes, bytes moved and latency per key, and flushes them to redis periodically.
+    Operations are attributed to the node of the calling thread, see set_node().
+    Use enable_stats() to create it.
+    """
+
+    def __init__(self, period=STATS_PERIOD):
+        self.period = period
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.default_node = f'pid_{os.getpid()}'
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def set_node(self, name):
+        """
+        Attribute operations of the calling thread to node name.
+        The first node also becomes the default for other threads.
+        """
+        self.local.node = name
+        if self.default_node.startswith("pid_"):
+            self.default_node = name
+
+    def record(self, op, keys, sizes, seconds):
+        node = getattr(self.local, "node", self.default_node)
+        bucket = f'lat_{bisect.bisect_left(LATENCY_BUCKETS, seconds * 1e6)}'
+        with self.lock:
+            for key, size in zip(keys, sizes):
+                for counter, n in ((op, 1), ("bytes", size), (bucket, 1)):
+                    name = (node, f'{key}|{counter}')
+                    self.counters[name] = self.counters.get(name, 0) + n
+
+    def count(self, key, counter, n=1):
+        """
+        Add n to a counter of key that is not an operation, such as the writes suppressed by write policies.
+        """
+        name = (getattr(self.local, "node", self.default_node), f'{key}|{counter}')
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def flush(self):
+        """
+        Add the counters to the stats hash of each node, and start counting from zero.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        if not counters:
+            return
+        pipe = connection.pipeline(transaction=False)
+        for (node, name), n in counters.items():
+            pipe.hincrby("stats_" + node, name, n)
+        pipe.sadd(STATS_KEY, *{"stats_" + node for node, name in counters})
+        pipe.execute()
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            try:
+                self.flush()
+            except redis.RedisError as e:
+                print(f'stats: flush failed: {e}')
+
+
+# per-process stats, disabled until enable_stats() is called or MIDDLEWARE_STATS is set
+stats = None
+
+def enable_stats(period=STATS_PERIOD):
+    """
+    Enable per-key stats for this process.
+    """
+    global stats
+    if stats is None:
+        stats = Stats(period)
+    return stats
+
+def read_stats():
+    """
+    Read the stats flushed by all nodes.
+    Returns a dictionary of nodes, each a dictionary of keys with their reads, writes, bytes, suppressed writes and latency histogram.
+    """
+    names = sorted(m.decode() for m in connection.smembers(STATS_KEY))
+    pipe = connection.pipeline(transaction=False)
+    for name in names:
+        pipe.hgetall(name)
+    result = {}
+    for name, counters in zip(names, pipe.execute()):
+        node = result.setdefault(name[len("stats_"):], {})
+        for k, n in counters.items():
+            key, counter = k.decode().rsplit("|", 1)
+            entry = node.setdefault(key, {"reads": 0, "writes": 0, "bytes": 0, "suppressed": 0, "latency": [0] * (len(LATENCY_BUCKETS) + 1)})
+            if counter.startswith("lat_"):
+                entry["latency"][int(counter[4:])] += int(n)
+            else:
+                entry[counter] += int(n)
+    return result
+
+def latency_percentile(histogram, p):
+    """
+    Upper bound, in microseconds, of the bucket holding percentile p of a latency histogram.
+    """
+    total = sum(histogram)
+    count = 0
+    for i, n in enumerate(histogram):
+        count += n
+        if total and count >= total * p / 100.0:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+    return 0
+
+def print_stats(top=20):
+    """
+    Print the keys and nodes with the most operations.
     """
-    return len(connection.keys(key)) > 0
+    per_node = read_stats()
+    per_key = {}
+    for node, keys in per_node.items():
+        for key, c in keys.items():
+            total = per_key.setdefault(key, {"reads": 0, "writes": 0, "bytes": 0, "suppressed": 0, "latency": [0] * (len(LATENCY_BUCKETS) + 1)})
+            for counter in ("reads", "writes", "bytes", "suppressed"):
+                total[counter] += c[counter]
+            total["latency"] = [a + b for a, b in zip(total["latency"], c["latency"])]
+    print(f'{"key":40s} {"reads":>10s} {"writes":>10s} {"suppressed":>10s} {"bytes":>12s} {"p50 us":>8s} {"p99 us":>8s}')
+    for key, c in sorted(per_key.items(), key=lambda kv: -(kv[1]["reads"] + kv[1]["writes"]))[:top]:
+        print(f'{key:40s} {c["reads"]:10d} {c["writes"]:10d} {c["suppressed"]:10d} {c["bytes"]:12d} '
+              f'{latency_percentile(c["latency"], 50):8} {latency_percentile(c["latency"], 99):8}')
+    print()
+    print(f'{"node":40s} {"reads":>10s} {"writes":>10s} {"bytes":>12s}')
+    totals = {
+        node: [sum(c[counter] for c in keys.values()) for counter in ("reads", "writes", "bytes")]
+        for node, keys in per_node.items()
+    }
+    for node, (reads, writes, nbytes) in sorted(totals.items(), key=lambda kv: -(kv[1][0] + kv[1][1]))[:top]:
+        print(f'{node:40s} {reads:10d} {writes:10d} {nbytes:12d}')
+
+def reset_stats():
+    """
+    Delete the stats flushed by all nodes.
+    """
+    names = connection.smembers(STATS_KEY)
+    if names:
+        connection.delete(*names)
+    connection.delete(STATS_KEY)
+
+
+_change_feed = None
+_change_feed_lock = threading.Lock()
+
+def get_change_feed():
+    """
+    Get the change feed shared by the process, starting it on first use.
+    """
+    global _change_feed
+    with _change_feed_lock:
+        if _change_feed is None:
+            _change_feed = ChangeFeed()
+        return _change_feed
+
+def reset_after_fork():
+    """
+    Drop the change feed and cached values inherited by a forked process.
+    The feed thread does not survive a fork, a new feed starts on first use.
+    """
+    global _change_feed, _change_feed_lock, _writers, default_writer
+    _change_feed = None
+    _change_feed_lock = threading.Lock()
+    # until it creates its own Node, the child is stamped as a process of its own
+    _writers = threading.local()
+    default_writer = f'pid_{os.getpid()}'
+    if cache is not None:
+        cache.reset()
+    if stats is not None:
+        stats.reset()
+    # the mapping survives the fork, but not the reader socket
+    if _frame_ring is not None:
+        _frame_ring.receiver = None
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+if os.environ.get("MIDDLEWARE_STATS", "0") not in ("", "0"):
+    enable_stats()
+
+
+# seconds between node heartbeats
+HEARTBEAT_PERIOD = 1.0
+
+# seconds after the last heartbeat for a node to be considered dead
+HEARTBEAT_TTL = 5.0
 
 
 class Node:
     """
     Node class.
     Initialize this class to signal node is running.
-    Use is_shutdown() to check if node should shutdown.
+    While running, a background thread refreshes an expiring heartbeat key with the node's pid and loop rate.
+    Use is_shutdown() to check if node should shutdown, it only checks a local flag.
     Use shutdown() to signal node is shutting down.
     Use loginfo(), logwarn() and logerror() to log messages.
+    Use watch() to be called back when a field changes.
+    Use wait_for_change() instead of sleeping in the main loop.
+    Use wait_for_command() to take the commands of a CommandQueue.
     """
 
     INFO = 0
@@ -111,8 +1390,21 @@ class Node:
         self.name = name
         set_key("node_" + name, os.getpid())
         set_key(name + "_is_shutdown", False)
+        connection.sadd(NODES_KEY, name)
+        set_writer(name)
+        if stats is not None:
+            stats.set_node(name)
         print(f'{name}: running')
         self.log_level = log_level
+        self.seen = {}
+        # shutdown requests are pushed by the change feed, and checked again on every heartbeat
+        self.shutdown_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.iterations = 0
+        get_change_feed().add_callback(name + "_is_shutdown", self.on_shutdown_key)
+        self.heartbeat()
+        self.heartbeat_thread = threading.Thread(target=self.run_heartbeat, daemon=True)
+        self.heartbeat_thread.start()
 
     def loginfo(self, message):
         if self.log_level <= Node.INFO:
@@ -130,11 +1422,86 @@ class Node:
         self.log_level = level
 
     def is_shutdown(self):
-        return get_key(self.name + "_is_shutdown")
+        """
+        Check if the node was asked to shutdown.
+        Meant for the condition of the main loop, calls are counted to report the loop rate.
+        """
+        self.iterations += 1
+        return self.shutdown_requested.is_set()
+
+    def on_shutdown_key(self, key):
+        if get_key(key):
+            self.shutdown_requested.set()
+
+    def heartbeat(self):
+        """
+        Refresh the heartbeat key, and check for a shutdown request the change feed could have missed.
+        """
+        now = time.time()
+        last, self.last_heartbeat = getattr(self, "last_heartbeat", None), now
+        iterations, self.iterations = self.iterations, 0
+        rate = iterations / (now - last) if last else 0.0
+        pipe = connection.pipeline(transaction=False)
+        pipe.set("heartbeat_" + self.name, json.dumps({"pid": os.getpid(), "time": now, "rate": rate}), px=int(HEARTBEAT_TTL * 1000))
+        pipe.get(self.name + "_is_shutdown")
+        if json.loads(pipe.execute()[1] or "false"):
+            self.shutdown_requested.set()
+
+    def run_heartbeat(self):
+        while not self.stopped.wait(HEARTBEAT_PERIOD):
+            try:
+                self.heartbeat()
+            except redis.RedisError as e:
+                print(f'{self.name}: heartbeat failed: {e}')
+
+    def watch(self, entry, field, callback):
+        """
+        Call callback(value) whenever field of entry changes.
+        Callbacks run in the change feed thread, keep them short.
+        """
+        def on_change(key):
+            callback(getattr(entry, field))
+        get_change_feed().add_callback(entry.key(field), on_change)
+        return on_change
+
+    def unwatch(self, entry, field, handle):
+        """
+        Stop a callback registered with watch(), using the handle it returned.
+        """
+        get_change_feed().remove_callback(entry.key(field), handle)
+
+    def wait_for_change(self, entry, *fields, timeout=None):
+        """
+        Block until one of the fields of entry changes, or the node is asked to shutdown.
+        Returns immediately the first time a field is waited on, so loops read the initial state.
+        Returns True if something changed, False on timeout.
+        """
+        keys = [entry.key(f) for f in fields] + [self.name + "_is_shutdown"]
+        seen = {k: self.seen.get(k) for k in keys}
+        changed = get_change_feed().wait(seen, timeout)
+        self.seen.update(seen)
+        return changed
+
+    def wait_for_command(self, queue, entry=None, *fields, timeout=None):
+        """
+        Take the next command of a CommandQueue, blocking until one is pushed or the node is asked to shutdown.
+        Also returns when one of the fields of entry changes, or after timeout seconds.
+        Returns the Command, or None if there was none.
+        """
+        wake = [self.name + "_is_shutdown"] + [entry.key(f) for f in fields]
+        return queue.pop(timeout, wake)
 
     def shutdown(self):
-        connection.delete("node_" + self.name)
-        connection.delete(self.name + "_is_shutdown")
+        self.stopped.set()
+        get_change_feed().remove_callback(self.name + "_is_shutdown", self.on_shutdown_key)
+        delete_keys("node_" + self.name, self.name + "_is_shutdown", "heartbeat_" + self.name)
+        connection.srem(NODES_KEY, self.name)
+        if cache is not None:
+            self.loginfo(f'cache: {get_cache_stats()}')
+        if write_filter.counts:
+            self.loginfo(f'suppressed writes: {get_suppressed_writes()}')
+        if stats is not None:
+            stats.flush()
         print(f'{self.name}: shutdown')
 
 
@@ -143,35 +1510,235 @@ class NodeManager:
     """
     NodeManager class.
     Use this class to list, shutdown or kill all nodes.
-    Nodes that hang can be force shutdown.
+    Use heartbeats() to see when each node was last seen, and its loop rate.
+    Nodes that hang can be force shutdown, unless they share their process with other nodes.
     """
 
     def list_nodes(self):
-        return [k.decode()[5:] for k in connection.keys("node_*")]
+        members = connection.smembers(NODES_KEY)
+        if members:
+            return [m.decode() for m in members]
+        return [k[5:] for k in find_keys("node_*")]
     
     def get_pid(self, name):
         return get_key("node_" + name)
 
     def is_running(self, name):        
+        import psutil
         pid = self.get_pid(name)
         return psutil.pid_exists(pid)
 
+    def heartbeats(self, names=None):
+        """
+        Read the last heartbeat of nodes, all listed nodes by default.
+        Returns a dictionary of nodes with their pid, last_seen in seconds ago and loop rate,
+        or None for nodes whose heartbeat expired.
+        """
+        names = self.list_nodes() if names is None else list(names)
+        if not names:
+            return {}
+        now = time.time()
+        result = {}
+        for name, raw in zip(names, connection.mget(["heartbeat_" + n for n in names])):
+            if raw is None:
+                result[name] = None
+            else:
+                beat = json.loads(raw)
+                result[name] = {"pid": beat["pid"], "last_seen": now - beat["time"], "rate": beat["rate"]}
+        return result
+
     def is_alive(self, name):
-        return name in self.list_nodes() and self.is_running(name)
+        """
+        Check if the node refreshed its heartbeat recently.
+        Unlike is_running(), this is not fooled by a new process reusing the pid of a dead node.
+        """
+        return connection.exists("heartbeat_" + name) != 0
 
     def shutdown(self, name):
         if self.is_alive(name):
             set_key(name + "_is_shutdown", True)
     
     def force_shutdown(self, name):
-        if name in self.list_nodes():
-            if self.is_running(name):
-                pid = self.get_pid(name)
+        """
+        Kill the process of a node that does not shutdown, and remove its keys.
+        The pid is taken from the node's heartbeat, so a process that reused the pid of a dead node is never killed.
+        A node whose heartbeat expired is already dead, its keys are removed without sending any signal.
+        """
+        nodes = self.list_nodes()
+        if name not in nodes:
+            return
+        beats = self.heartbeats(nodes)
+        if beats[name] is not None:
+            pid = beats[name]["pid"]
+            # nodes hosted by node_runner.py share a process, killing it would kill them all
+            shared = [n for n, beat in beats.items() if n != name and beat is not None and beat["pid"] == pid]
+            if shared:
+                print(f'{name}: process {pid} also runs {", ".join(sorted(shared))}, not killed')
+                return
+            try:
                 os.kill(pid, signal.SIGKILL)
-                time.sleep(1.0)
-            if not self.is_running(name):
-                connection.delete("node_" + name)
-                connection.delete(name + "_is_shutdown")
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                print(f'{name}: no permission to kill process {pid}')
+                return
+            time.sleep(1.0)
+        delete_keys("node_" + name, name + "_is_shutdown", "heartbeat_" + name)
+        connection.srem(NODES_KEY, name)
+
+
+# seconds the status of a command is kept, for producers to wait on
+COMMAND_STATUS_TTL = 3600
+
+
+class Command:
+    """
+    Command class.
+    A command taken from a CommandQueue, with its id, operation and arguments.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        message = json.loads(raw)
+        self.id = message["id"]
+        self.op = message["op"]
+        self.args = message["args"]
+
+
+class CommandQueue:
+    """
+    CommandQueue class.
+    Reliable queue of commands for a driver, in a redis list named queue_<name>.
+    Unlike a field, every command pushed is delivered, in order, even if several are pushed at once.
+    Use push() to queue a command, it returns an id to wait() on until the command is done.
+    The consumer takes commands with pop(), or Node.wait_for_command(), and acknowledges them with ack().
+    Taken commands stay in the queue_<name>_pending list until acknowledged,
+    recover() puts back those a crashed consumer left, so each queue has a single consumer.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = "queue_" + name
+        self.pending_key = self.key + "_pending"
+        self.ids_key = self.key + "_ids"
+
+    def status_key(self, id):
+        return f'{self.key}_{id}'
+
+    def set_status(self, pipe, id, state, result=None):
+        pipe.set(self.status_key(id), json.dumps({"state": state, "result": result}), ex=COMMAND_STATUS_TTL)
+
+    def push(self, op, **args):
+        """
+        Queue a command, returns its id.
+        """
+        start = time.perf_counter()
+        id = connection.incr(self.ids_key)
+        payload = json.dumps({"id": id, "op": op, "args": args})
+        pipe = connection.pipeline()
+        self.set_status(pipe, id, "queued")
+        pipe.lpush(self.key, payload)
+        pipe.execute()
+        record("writes", [self.key], [payload], start)
+        return id
+
+    def pop(self, timeout=None, wake=()):
+        """
+        Take the next command, blocking until one is pushed, or timeout seconds passed.
+        Waiting goes through the change feed, so it does not hold a connection or poll.
+        Also returns if one of the keys in wake changes.
+        Returns the Command, or None if there was none.
+        """
+        feed = get_change_feed()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # versions are read before the list, so a push right after it is not missed
+            seen = {k: feed.version(k) for k in (self.key, *wake)}
+            versions = dict(seen)
+            start = time.perf_counter()
+            raw = connection.rpoplpush(self.key, self.pending_key)
+            if raw is not None:
+                record("reads", [self.key], [raw], start)
+                command = Command(raw)
+                pipe = connection.pipeline(transaction=False)
+                self.set_status(pipe, command.id, "running")
+                pipe.execute()
+                return command
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            if not feed.wait(seen, remaining) or any(seen[k] != versions[k] for k in wake):
+                return None
+
+    def ack(self, command, result=None, error=None):
+        """
+        Acknowledge a command taken with pop(), with its result, or the error that made it fail.
+        """
+        pipe = connection.pipeline()
+        pipe.lrem(self.pending_key, 1, command.raw)
+        if error is None:
+            self.set_status(pipe, command.id, "done", result)
+        else:
+            self.set_status(pipe, command.id, "failed", error)
+        pipe.execute()
+
+    def recover(self):
+        """
+        Put the commands left unacknowledged by a previous consumer back at the head of the queue.
+        Returns how many were put back.
+        """
+        # the pending list holds the newest command first, the queue is consumed from the right
+        pending = connection.lrange(self.pending_key, 0, -1)
+        if pending:
+            pipe = connection.pipeline()
+            pipe.rpush(self.key, *pending)
+            pipe.delete(self.pending_key)
+            pipe.execute()
+        return len(pending)
+
+    def status(self, id):
+        """
+        Status of a command, a dictionary with its state (queued, running, done or failed) and result.
+        Returns None for unknown commands, and commands done more than COMMAND_STATUS_TTL seconds ago.
+        """
+        raw = connection.get(self.status_key(id))
+        return json.loads(raw) if raw is not None else None
+
+    def wait(self, id, timeout=None):
+        """
+        Block until a command is done or failed, or timeout seconds passed.
+        Returns its last status, see status().
+        """
+        key = self.status_key(id)
+        feed = get_change_feed()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            seen = {key: feed.version(key)}
+            status = self.status(id)
+            if status is None or status["state"] in ("done", "failed"):
+                return status
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None and remaining <= 0) or not feed.wait(seen, remaining):
+                return self.status(id)
+
+    def __len__(self):
+        return connection.llen(self.key)
+
+
+def snapshot(*requests):
+    """
+    Read fields of several entries in a single round trip.
+    Each request is an entry, or a tuple of an entry and the fields to read.
+    Returns a list with a dictionary of values per request.
+    """
+    requests = [r if isinstance(r, tuple) else (r, None) for r in requests]
+    requests = [(e, list(e.fields) if f is None else list(f)) for e, f in requests]
+    owners = {e.key(f): (e, f) for e, fields in requests for f in fields}
+    values = read_fields([(e, f) for e, fields in requests for f in fields if not e.is_cached(f)])
+    cached = [e.key(f) for e, fields in requests for f in fields if e.is_cached(f)]
+    if cached:
+        values.update(cache.get_many(cached, lambda missing: read_fields([owners[k] for k in missing])))
+    return [{f: values[e.key(f)] for f in fields} for e, fields in requests]
 
 
 class DBEntry:
@@ -181,24 +1748,132 @@ class DBEntry:
     Extend this class to define data that will be stored in the database.
     The fields attribute defines the data that will be stored.
     The prefix attribute defines the prefix that will be used to store the data.
+    The cached_fields attribute lists fields that can be kept in the process cache, see enable_cache().
+    The recorded_fields attribute lists fields whose last history_length values are kept, see history().
+    The write_policies attribute maps fields to the policy deciding which of their writes are published:
+    - skip_equal: skip writes of the value last published.
+    - deadband: skip writes that differ from the value last published by at most this much.
+    - relative_deadband: the same, as a fraction of the value last published.
+    - max_rate: publish at most this many writes per second.
+    - max_interval: publish a write anyway if the last one was published this many seconds ago.
+    Skipped writes are counted, see get_suppressed_writes().
+    Every write is stamped with its time and writer, use age() and is_fresh() to tell live values from
+    values left behind by a node that stopped.
     """
 
     prefix = ''
     fields = {}
-    def __init__(self):
-        for k in self.fields:
-            setattr(self.__class__, k, property(self.getter(k), self.setter(k)))
+    cached_fields = ()
+    recorded_fields = ()
+    history_length = 1000
+    write_policies = {}
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Install a property per field once, when the subclass is defined.
+        Defaults are stored the first time a field is found missing, or by seed_defaults().
+        """
+        super().__init_subclass__(**kwargs)
+        entries[cls.prefix] = cls
+        for k in cls.fields:
+            setattr(cls, k, property(cls.getter(k), cls.setter(k)))
+
+    @classmethod
+    def key(cls, field):
+        """
+        Name of the database key that stores field.
+        With the hash storage layout, this name is still used to watch and cache the field.
+        """
+        return f'{cls.prefix}_{field}'
+    
+    def snapshot(self, fields=None):
+        """
+        Read several fields in a single round trip.
+        Returns a dictionary with the values of fields, or of all fields if None.
+        """
+        return snapshot((self, fields))[0]
+
+    def history(self, *fields, start=None, end=None, last=None):
+        """
+        Read the recorded values of fields, see read_history().
+        Returns a dictionary with a tuple of numpy arrays, timestamps and values, per field.
+        """
+        return read_history(self, fields, start, end, last)
+
+    def history_after(self, last_ids):
+        """
+        Read the values of fields recorded after the last ones read, see read_history_after().
+        Returns a dictionary with a tuple of numpy arrays, timestamps and values, per field.
+        """
+        return read_history_after(self, last_ids)
+
+    def written(self, fields=None):
+        """
+        Read when, and by whom, fields were last written, or all fields if None.
+        Returns a dictionary of fields with their age in seconds and their writer, without the fields never written.
+        """
+        fields = list(self.fields) if fields is None else list(fields)
+        times = read_write_times([(self, f) for f in fields])
+        now = time.monotonic()
+        return {f: (now - times[self.key(f)][0], times[self.key(f)][1]) for f in fields if self.key(f) in times}
+
+    def age(self, field):
+        """
+        Seconds since field was last written, None if it never was, as when it still holds its default.
+        """
+        return read_ages([(self, field)])[self.key(field)]
+
+    def is_fresh(self, field, max_age):
+        """
+        Check if field was written in the last max_age seconds.
+        """
+        age = self.age(field)
+        return age is not None and age <= max_age
+
+    def update(self, **values):
+        """
+        Write several fields atomically, in a single round trip.
+        """
+        for f in values:
+            if f not in self.fields:
+                raise AttributeError(f'{self.__class__.__name__} has no field {f}')
+        write_fields(self, values)
+        if not in_transaction():
+            for f, v in values.items():
+                if self.is_cached(f):
+                    cache.put(self.key(f), v)
+
+    @classmethod
+    def encode(cls, field, value):
+        return json.dumps(value)
+
+    @classmethod
+    def decode(cls, field, raw):
+        return json.loads(raw)
+
+    def is_cached(self, field):
+        return cache is not None and field in self.cached_fields
+
+    def read(self, field):
+        """
+        Read field from the database, storing its default if it is not set.
+        """
+        return read_fields([(self, field)])[self.key(field)]
     
-    def getter(self, key):
+    @staticmethod
+    def getter(key):
         def do_get(self):
-            if not has_key(f'{self.prefix}_{key}'):
-                set_key(f'{self.prefix}_{key}', self.fields[key])
-            return get_key(f'{self.prefix}_{key}')
+            if self.is_cached(key):
+                return cache.get(self.key(key), lambda: self.read(key))
+            return self.read(key)
         return do_get
     
-    def setter(self, key):
+    @staticmethod
+    def setter(key):
         def do_set(self, value):
-            set_key(f'{self.prefix}_{key}', value)
+            write_fields(self, {key: value})
+            if self.is_cached(key) and not in_transaction():
+                cache.put(self.key(key), value)
         return do_set
 
 
@@ -211,6 +1886,7 @@ class Robot(DBEntry):
     fields = {
         "name": "Elmo V2",
     }
+    cached_fields = ("name",)
 
 
 class Camera(DBEntry):
@@ -222,6 +1898,7 @@ class Camera(DBEntry):
     fields = {
         "url": "http://elmo2:8080/stream.mjpg",
     }
+    cached_fields = ("url",)
 
 
 class Microphone(DBEntry):
@@ -258,25 +1935,228 @@ class Battery(DBEntry):
         'ad_at_16v': 765.021,
         'percentage': 100.0
     }
+    cached_fields = ("i2c_address", "ad_at_13v", "ad_at_16v")
+    recorded_fields = ("raw", "voltage")
+    history_length = 10000
+    # sampled every 100 ms, published when it moves
+    write_policies = {
+        "raw": {"deadband": 1.0, "max_interval": 5.0},
+        "voltage": {"deadband": 0.01, "max_interval": 5.0},
+        "percentage": {"deadband": 0.5, "max_interval": 30.0},
+    }
+
+
+# memory mapped file holding the last LED frames, one per database
+FRAME_RING_PATH = "/dev/shm/elmo_leds_{db}"
+
+# number of frames kept in the ring
+FRAME_RING_SLOTS = 8
+
+
+class FrameRing:
+    """
+    FrameRing class.
+    Ring of the last frames shown, in a memory mapped file shared by the processes on this machine.
+    The file starts with the sequence number of the last frame, followed by the slots,
+    each a sequence number and a frame. Frame n is stored in slot n % slots.
+    Use write() to add a frame, read() to get the last one and wait() to block until a new one is written.
+    Writers wake up the reader waiting in wait() through a unix datagram socket.
+    The file and the socket are shared with the group of the user, see backends.share(),
+    as driver_leds runs as root and the nodes showing frames do not.
+    """
+
+    SEQUENCE = struct.Struct("<Q")
+
+    def __init__(self, path, frame_size, slots=FRAME_RING_SLOTS):
+        self.path = path
+        self.frame_size = frame_size
+        self.slots = slots
+        self.slot_size = self.SEQUENCE.size + frame_size
+        size = self.SEQUENCE.size + slots * self.slot_size
+        import backends
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, backends.SHARED_FILE_MODE)
+        backends.share(path)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # a ring of another size is reset
+            if os.fstat(self.fd).st_size != size:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, size)
+        self.lock = threading.Lock()
+        self.socket_path = path + ".sock"
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.receiver = None
+        self.unreachable = False
+
+    def offset(self, sequence):
+        return self.SEQUENCE.size + (sequence % self.slots) * self.slot_size
+
+    def sequence(self):
+        """
+        Sequence number of the last frame, 0 if none was written.
+        """
+        return self.SEQUENCE.unpack_from(self.map, 0)[0]
+
+    def write(self, frame):
+        """
+        Add a frame to the ring and wake up the reader, returns its sequence number.
+        """
+        if len(frame) != self.frame_size:
+            raise ValueError(f'frame has {len(frame)} bytes, expected {self.frame_size}')
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                sequence = self.sequence() + 1
+                offset = self.offset(sequence)
+                # the slot is marked as being written until the frame is complete
+                self.SEQUENCE.pack_into(self.map, offset, 0)
+                self.map[offset + self.SEQUENCE.size:offset + self.slot_size] = frame
+                self.SEQUENCE.pack_into(self.map, offset, sequence)
+                self.SEQUENCE.pack_into(self.map, 0, sequence)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        try:
+            self.sender.sendto(b"", self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # no reader is waiting
+            pass
+        except BlockingIOError:
+            # the reader has wake ups pending already
+            pass
+        except PermissionError:
+            # the reader only sees the frame on its next timeout
+            if not self.unreachable:
+                self.unreachable = True
+                print(f'frame ring: no permission to wake up the reader on {self.socket_path}, frames will be late')
+        return sequence
+
+    def read(self):
+        """
+        Read the last frame, returns its sequence number and the frame.
+        Before the first frame, returns 0 and a blank frame.
+        """
+        while True:
+            sequence = self.sequence()
+            if sequence == 0:
+                return 0, bytes(self.frame_size)
+            offset = self.offset(sequence)
+            frame = self.map[offset + self.SEQUENCE.size:offset + self.slot_size]
+            # retry if the slot was overwritten while it was copied
+            if self.SEQUENCE.unpack_from(self.map, offset)[0] == sequence:
+                return sequence, frame
+
+    def wait(self, sequence, timeout=None):
+        """
+        Block until the last frame is not sequence.
+        Only one process at a time can wait on a ring.
+        Returns True if a new frame was written, False on timeout.
+        """
+        if self.receiver is None:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.receiver.bind(self.socket_path)
+            import backends
+            backends.share(self.socket_path)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sequence() == sequence:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.receiver.settimeout(remaining)
+            try:
+                self.receiver.recv(1)
+            except socket.timeout:
+                return False
+        return True
+
+
+_frame_ring = None
+_frame_ring_lock = threading.Lock()
+
+def get_frame_ring(frame_size):
+    """
+    Get the frame ring shared by the Leds of this process, mapping it on first use.
+    """
+    global _frame_ring
+    with _frame_ring_lock:
+        if _frame_ring is None:
+            _frame_ring = FrameRing(FRAME_RING_PATH.format(db=get_db()), frame_size)
+        return _frame_ring
 
 
 class Leds(DBEntry):
     """
     Database entry.
     LED information.
-    Set colors to a list of 3-element tuples to set the colors.
     The led matrix has 169 leds, arranged in a 13x13 grid.
+    Use show() to display a frame, a bytes object with one RGB triplet per led.
+    Frames are not stored in the database, they go through a FrameRing in shared memory.
+    Check frame and sequence to see the last frame and how many frames were shown.
+    Use frames() to get the ring, to wait for new frames.
+    Use show_icon() to queue an icon for the driver to load, or load_from_url() to load it in this process.
+    Set colors to a list of 3-element tuples to set the colors, it is converted to a frame.
     Set brightness to a value between 0.0 and 1.0 to set the brightness.
     """
     prefix = "leds"
     fields = {
         'ready': False,
         'number': 169,
-        'colors': [[0, 0, 0]] * 169,
         'brightness': 0.3
     }
+    cached_fields = ("number", "brightness")
+
+    def frames(self):
+        """
+        Get the ring holding the last frames.
+        """
+        return _frame_ring or get_frame_ring(3 * self.number)
+
+    @staticmethod
+    def encode_colors(colors):
+        """
+        Convert a list of 3-element colors to a frame.
+        """
+        return bytes(max(0, min(255, int(c))) for color in colors for c in color[0:3])
+
+    @staticmethod
+    def decode_colors(frame):
+        """
+        Convert a frame to a list of 3-element colors.
+        """
+        return [list(frame[i:i + 3]) for i in range(0, len(frame), 3)]
+
+    def show(self, frame):
+        """
+        Display a frame, returns its sequence number.
+        """
+        return self.frames().write(frame)
+
+    @property
+    def frame(self):
+        return self.frames().read()[1]
+
+    @property
+    def sequence(self):
+        return self.frames().sequence()
+
+    @property
+    def colors(self):
+        return self.decode_colors(self.frame)
+
+    @colors.setter
+    def colors(self, colors):
+        self.show(self.encode_colors(colors))
 
     def load_from_url(self, url):
+        # imported here, most nodes never load images
+        import requests
+        from io import BytesIO
+        from PIL import Image
         # gif
         if ".gif" in url:
             response = requests.get(url)
@@ -293,18 +2173,13 @@ class Leds(DBEntry):
                             im = image.convert("RGB")
                             color = im.getpixel((12 - col, row))[0:3]
                             colors.append(color)
-                    frames.append(colors)
+                    frames.append(self.encode_colors(colors))
             except EOFError:
-                final_color = [[0, 0, 0]] * self.number
-                frames.append(final_color)
+                frames.append(bytes(3 * self.number))
             # schedule the publishing of the messages
             time_between_frames = image.info["duration"] / 1000.0
             for i in range(len(frames)):
-                def set_colors(colors):
-                    def update_colors():
-                        self.colors = colors
-                    return update_colors
-                t = threading.Timer(time_between_frames * i, set_colors(frames[i]))
+                t = threading.Timer(time_between_frames * i, self.show, args=(frames[i],))
                 t.start()
         else:
             colors = []
@@ -316,10 +2191,20 @@ class Leds(DBEntry):
                     # color = image.getpixel((col, 12 - row))
                     color = image.getpixel((12 - col, row))[0:3]
                     colors.append(color)
-            self.colors = colors
+            self.show(self.encode_colors(colors))
     
     def clear(self):
-        self.colors = [[0, 0, 0]] * self.number
+        self.show(bytes(3 * self.number))
+
+    def commands(self):
+        return CommandQueue(self.prefix)
+
+    def show_icon(self, url):
+        """
+        Queue an icon for driver_leds.py to load with load_from_url().
+        Returns the id of the command, to wait on with commands().wait().
+        """
+        return self.commands().push("icon", url=url)
 
 
 
@@ -351,13 +2236,14 @@ class GPIO(DBEntry):
         'button_pressed': False,
         'robot_shutdown': False,
     }
+    cached_fields = ("button_pin", "shutdown_pin", "stay_enable_pin", "audio_pin", "monitor_pin")
 
 
 class Speakers(DBEntry):
     """
     Database entry.
     Speaker information.
-    Set url to a url to play a sound.
+    Use play() to queue a sound, by url, and stop() to stop it and the sounds queued after it.
     Set volume to a value between 0 and 100 to set the volume.
     Check playing to see if a sound is playing.
     """
@@ -365,10 +2251,22 @@ class Speakers(DBEntry):
     fields = {
         "ready": False,
         "volume": 70,
-        "url": None,
         "playing": None,
     }
 
+    def commands(self):
+        return CommandQueue(self.prefix)
+
+    def play(self, url):
+        """
+        Queue a sound, sounds are played one after the other.
+        Returns the id of the command, to wait on with commands().wait().
+        """
+        return self.commands().push("play", url=url)
+
+    def stop(self):
+        return self.commands().push("stop")
+
 
 class TouchSensors(DBEntry):
     """
@@ -401,6 +2299,16 @@ class TouchSensors(DBEntry):
         "head_3_raw": 0,
         "sensitivity": 5,
     }
+    cached_fields = ("sensitivity",)
+    recorded_fields = ("chest_raw", "head_0_raw", "head_1_raw", "head_2_raw", "head_3_raw")
+    # sampled every 100 ms, published when it moves, so the calibrator sees at least one value per second
+    write_policies = {
+        "chest_raw": {"deadband": 1, "max_interval": 1.0},
+        "head_0_raw": {"deadband": 1, "max_interval": 1.0},
+        "head_1_raw": {"deadband": 1, "max_interval": 1.0},
+        "head_2_raw": {"deadband": 1, "max_interval": 1.0},
+        "head_3_raw": {"deadband": 1, "max_interval": 1.0},
+    }
 
     def head_touch(self):
         """
@@ -448,6 +2356,8 @@ class Pan(DBEntry):
         "temperature": 0,
         "angle_bias": 12.0
     }
+    cached_fields = ("id", "pid_p", "pid_d", "max_angle", "min_angle", "min_playtime", "max_playtime", "angle_bias")
+    recorded_fields = ("current_angle", "temperature")
 
 
 class Tilt(DBEntry):
@@ -484,6 +2394,8 @@ class Tilt(DBEntry):
         "temperature": 0,
         "angle_bias": 2.3
     }
+    cached_fields = ("id", "pid_p", "pid_d", "max_angle", "min_angle", "min_playtime", "max_playtime", "angle_bias")
+    recorded_fields = ("current_angle", "temperature")
 
 
 class Onboard(DBEntry):
@@ -514,16 +2426,26 @@ class Speech(DBEntry):
     Speech information.
     Check ready to see if speech driver is ready.
     Set language to a language code to set the language.
-    Set say to a string to say something.
+    Use say() to queue a text to say.
     Check saying to see what is being said.
     """
     prefix = "speech"
     fields = {
         "ready": False,
         "language": "en",
-        "say": None,
         "saying": None,
     }
+    cached_fields = ("language",)
+
+    def commands(self):
+        return CommandQueue(self.prefix)
+
+    def say(self, text):
+        """
+        Queue a text, texts are said one after the other, even if the same text is queued twice.
+        Returns the id of the command, to wait on with commands().wait().
+        """
+        return self.commands().push("say", text=text)
 
 
 class Server(DBEntry):
@@ -541,11 +2463,13 @@ class Server(DBEntry):
         "api_port": 8001,
         "static_path": "static",
     }
+    cached_fields = ("http_port", "udp_port", "api_port", "static_path")
 
     # def wait_for_ready(self):
     #     while not self.ready:
     #         time.sleep(0.1)
     def wait_for_ready(self):
+        import requests
         while True:
             try:
                 requests.get("http://elmo:8000/")
@@ -570,6 +2494,7 @@ class Server(DBEntry):
         return ""
     
     def get_image_list(self):
+        import requests
         try:
             url = self.url_for_image("")[:-1]
             response = requests.get(url)
@@ -578,6 +2503,7 @@ class Server(DBEntry):
             return []
     
     def get_sound_list(self):
+        import requests
         try:
             url = self.url_for_sound("")[:-1]
             response = requests.get(url)
@@ -586,6 +2512,7 @@ class Server(DBEntry):
             return []
     
     def get_icon_list(self):
+        import requests
         try:
             url = self.url_for_icon("")[:-1]
             response = requests.get(url)
@@ -594,6 +2521,7 @@ class Server(DBEntry):
             return []
     
     def get_video_list(self):
+        import requests
         try:
             url = self.url_for_video("")[:-1]
             response = requests.get(url)
@@ -617,6 +2545,7 @@ class Power(DBEntry):
         "gpio_shutdown": True,
         "battery_shutdown": True,
     }
+    cached_fields = ("gpio_shutdown", "battery_shutdown")
 
 
 class Behaviours(DBEntry):
@@ -633,20 +2562,25 @@ class Behaviours(DBEntry):
         "blush": True,
         "change_mode": True,
     }
+    cached_fields = ("look_around", "blush", "change_mode")
 
     def list_behaviours(self):
         return self.fields.keys()
 
 
 if __name__ == '__main__':
-    usage = "usage: python3 middleware.py <list|killall|shutdown|force_shutdown|state|monitor|reset>"
+    usage = "usage: python3 middleware.py <list|killall|shutdown|force_shutdown|state|monitor|reset|migrate|stats>"
     if len(sys.argv) == 1:
         print(usage)
         sys.exit(1)
     manager = NodeManager()    
     if sys.argv[1] == "list":
-        node_list = manager.list_nodes()
-        print(json.dumps(sorted(node_list), indent=2))
+        print(f'{"node":30s} {"pid":>8s} {"last seen":>10s} {"loop rate":>10s}')
+        for name, beat in sorted(manager.heartbeats().items()):
+            if beat is None:
+                print(f'{name:30s} {"-":>8s} {"dead":>10s} {"-":>10s}')
+            else:
+                print(f'{name:30s} {beat["pid"]:8d} {beat["last_seen"]:9.1f}s {beat["rate"]:8.1f}/s')
     elif sys.argv[1] == "killall":
         for name in manager.list_nodes():
             manager.shutdown(name)
@@ -663,15 +2597,23 @@ if __name__ == '__main__':
     elif sys.argv[1] == "state":
         get_all()
     elif sys.argv[1] == "monitor":
+        args = [a for a in sys.argv[2:] if not a.startswith("--")]
         try:
-            while True:
-                print("---")
-                get_all(*sys.argv[2:])
-                time.sleep(0.1)
+            if "--rates" in sys.argv:
+                monitor_rates(*args)
+            else:
+                monitor(*args, values="--values" in sys.argv)
         except KeyboardInterrupt:
             pass
     elif sys.argv[1] == "reset":
         delete_all()
+    elif sys.argv[1] == "migrate":
+        migrate_storage()
+    elif sys.argv[1] == "stats":
+        if len(sys.argv) == 3 and sys.argv[2] == "reset":
+            reset_stats()
+        else:
+            print_stats(int(sys.argv[2]) if len(sys.argv) == 3 else 20)
     else:
         print(usage)
         sys.exit(1)
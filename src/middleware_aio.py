@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+
+
+"""
+
+Asyncio flavour of the middleware.
+
+Defines an AsyncEntry class for every DBEntry class of middleware.py, under the same name,
+so both flavours share the same field definitions and read and write the same data:
+
+    import middleware_aio as aio
+
+    async def main():
+        leds = aio.Leds()
+        await leds.set("brightness", 0.5)
+        number = await leds.get("number")
+        async for field, value in aio.watch(aio.TouchSensors(), "touch_head_0", "touch_head_1"):
+            print(field, value)
+
+With the redis backend, commands go through redis.asyncio.
+The local and shm backends keep their data in memory and are called directly.
+
+Writes made through this module are not part of a middleware.transaction(),
+but each update() writes its fields atomically.
+
+"""
+
+
+import asyncio
+import time
+import weakref
+
+import redis.asyncio
+
+import middleware as mw
+
+
+# connections by event loop, an asyncio connection can only be used by the loop that created it
+_connections = weakref.WeakKeyDictionary()
+
+
+def get_connection():
+    """
+    Get the asyncio connection of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _connections:
+        if mw.BACKEND == "redis":
+            config = mw.get_connection_config()
+            if config["unix_socket"]:
+                pool = redis.asyncio.BlockingConnectionPool(
+                    connection_class=redis.asyncio.UnixDomainSocketConnection,
+                    path=config["unix_socket"],
+                    db=config["db"],
+                    max_connections=config["pool_size"],
+                    socket_timeout=config["timeout"],
+                    socket_connect_timeout=config["connect_timeout"],
+                )
+            else:
+                pool = redis.asyncio.BlockingConnectionPool(
+                    host=config["host"],
+                    port=config["port"],
+                    db=config["db"],
+                    max_connections=config["pool_size"],
+                    socket_timeout=config["timeout"],
+                    socket_connect_timeout=config["connect_timeout"],
+                    socket_keepalive=config["keepalive"],
+                )
+            _connections[loop] = redis.asyncio.Redis(connection_pool=pool)
+        else:
+            _connections[loop] = LocalAsyncConnection(mw.connection)
+    return _connections[loop]
+
+
+class LocalAsyncConnection:
+    """
+    LocalAsyncConnection class.
+    Gives the local and shm backends the interface of a redis.asyncio client.
+    Commands run directly, only waiting for messages runs in a thread.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def pipeline(self, transaction=True):
+        return LocalAsyncPipeline(self.connection.pipeline(transaction))
+
+    def pubsub(self):
+        return LocalAsyncPubSub(self.connection.pubsub())
+
+
+class LocalAsyncPipeline:
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def __getattr__(self, name):
+        command = getattr(self.pipe, name)
+        def queue_command(*args, **kwargs):
+            command(*args, **kwargs)
+            return self
+        return queue_command
+
+    async def execute(self, raise_on_error=True):
+        return self.pipe.execute(raise_on_error)
+
+
+class LocalAsyncPubSub:
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def psubscribe(self, *patterns):
+        self.pubsub.psubscribe(*patterns)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        return await asyncio.get_running_loop().run_in_executor(None, self.pubsub.get_message, ignore_subscribe_messages, timeout)
+
+    async def aclose(self):
+        self.pubsub.close()
+
+
+async def close_pubsub(pubsub):
+    # redis.asyncio renamed close() to aclose()
+    if hasattr(pubsub, "aclose"):
+        await pubsub.aclose()
+    else:
+        await pubsub.close()
+
+
+async def read_fields(pairs):
+    """
+    Read fields of several entries in a single round trip, see middleware.read_fields().
+    """
+    connection = get_connection()
+    start = time.perf_counter()
+    pipe = connection.pipeline(transaction=False)
+    pairs = mw.queue_reads(pipe, pairs)
+    raw = [v for reply in await pipe.execute() for v in reply]
+    mw.record("reads", [e.key(f) for e, f in pairs], raw, start)
+    values, missing = mw.decode_fields(pairs, raw)
+    if missing:
+        pipe = connection.pipeline(transaction=False)
+        mw.queue_defaults(pipe, {e.prefix: e for e, f in missing}.values())
+        await pipe.execute()
+        values.update({e.key(f): e.fields[f] for e, f in missing})
+    return values
+
+
+async def write_fields(entry, values):
+    """
+    Write several fields of an entry atomically, in a single round trip, see middleware.write_fields().
+    """
+    if entry.write_policies:
+        values = mw.write_filter.filter(entry, values)
+    if not values:
+        return
+    start = time.perf_counter()
+    payloads = {f: entry.encode(f, v) for f, v in values.items()}
+    pipe = get_connection().pipeline()
+    mw.queue_fields(pipe, entry, payloads)
+    await pipe.execute()
+    mw.record("writes", [entry.key(f) for f in payloads], list(payloads.values()), start)
+    if entry.write_policies:
+        mw.write_filter.mark_published(entry, values)
+    for f, v in values.items():
+        if entry.is_cached(f):
+            mw.cache.put(entry.key(f), v)
+
+
+class AsyncEntry:
+    """
+    AsyncEntry class.
+    Asyncio counterpart of a DBEntry class, named by entry_class.
+    Use get() and set() instead of the field properties, snapshot() and update() as with DBEntry.
+    """
+
+    entry_class = None
+
+    def __init__(self):
+        self.entry = self.entry_class()
+
+    def key(self, field):
+        return self.entry.key(field)
+
+    async def get(self, field):
+        """
+        Read a field.
+        Properties of the DBEntry class that are not fields, such as Leds.colors, are read from it.
+        """
+        if field not in self.entry.fields:
+            return getattr(self.entry, field)
+        return (await self.snapshot([field]))[field]
+
+    async def set(self, field, value):
+        await self.update(**{field: value})
+
+    async def snapshot(self, fields=None):
+        """
+        Read several fields in a single round trip.
+        Returns a dictionary with the values of fields, or of all fields if None.
+        """
+        fields = list(self.entry.fields) if fields is None else list(fields)
+        values = await read_fields([(self.entry, f) for f in fields])
+        return {f: values[self.entry.key(f)] for f in fields}
+
+    async def update(self, **values):
+        """
+        Write several fields atomically, in a single round trip.
+        """
+        for f in values:
+            if f not in self.entry.fields:
+                raise AttributeError(f'{self.entry_class.__name__} has no field {f}')
+        await write_fields(self.entry, values)
+
+
+async def watch(entry, *fields):
+    """
+    Yield (field, value) each time one of fields of entry changes.
+    entry is an AsyncEntry or a DBEntry.
+    """
+    entry = getattr(entry, "entry", entry)
+    keys = {entry.key(f): f for f in fields}
+    pubsub = get_connection().pubsub()
+    channels = [f'__keyspace@{mw.get_db()}__:{k}' for k in keys] + [mw.field_channel(k) for k in keys]
+    mw.enable_notifications()
+    await pubsub.psubscribe(*channels, mw.transaction_channel())
+    announced = mw.AnnouncedKeys(keys)
+    try:
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            changed = announced.changed(message)
+            if changed:
+                values = await read_fields([(entry, keys[k]) for k in changed])
+                for k in changed:
+                    yield keys[k], values[k]
+    finally:
+        await close_pubsub(pubsub)
+
+
+# an AsyncEntry class for every DBEntry class, under the same name
+for _entry_class in mw.entries.values():
+    globals()[_entry_class.__name__] = type(_entry_class.__name__, (AsyncEntry,), {
+        "entry_class": _entry_class,
+        "__doc__": _entry_class.__doc__,
+    })
@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+
+
+"""
+
+Node runner.
+
+Runs several nodes in a single interpreter, each in its own thread, instead of one process per node.
+Hosted nodes share the middleware connection, field cache and change feed of the process,
+and keep their own name, heartbeat and shutdown key, so NodeManager lists and stops them as usual.
+Nodes whose run() is a coroutine, such as behaviour_blush, get an event loop in their thread.
+
+usage: python3 node_runner.py [node ...]
+
+Without arguments, runs all nodes in NODES.
+Nodes that need root, such as driver_leds, and the flask servers keep their own process.
+
+"""
+
+
+import asyncio
+import importlib
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import middleware as mw
+
+
+# nodes that can be hosted, by node name: (module, class)
+NODES = {
+    "driver_battery": ("driver_battery", "DriverBattery"),
+    "driver_gpio": ("driver_gpio", "DriverGpio"),
+    "driver_pan_tilt": ("driver_pan_tilt", "DriverPanTilt"),
+    "driver_power": ("driver_power", "DriverPower"),
+    "driver_speakers": ("driver_speakers", "DriverSpeakers"),
+    "driver_touch_sensors": ("driver_touch_sensors", "DriverTouchSensors"),
+    "driver_microphone": ("driver_microphone", "DriverMicrophone"),
+    "driver_speech": ("driver_speech", "DriverSpeech"),
+    "touch_calibrator": ("touch_calibrator", "TouchCalibrator"),
+    "behaviour_blush": ("behaviour_blush", "BehaviourBlush"),
+    "behaviour_look_around": ("behaviour_look_around", "BehaviourLookAround"),
+    "behaviour_change_mode": ("behaviour_change_mode", "ModeManager"),
+    "config_loader": ("load_config", "ConfigLoader"),
+}
+
+# seconds to wait for nodes to stop after a shutdown request, before leaving them behind
+SHUTDOWN_TIMEOUT = 10.0
+
+
+class NodeRunner:
+    """
+    NodeRunner class.
+    Use start() to start the nodes, wait() to block until they all stopped, and shutdown() to ask them to stop.
+    Each node is imported and created in its own thread, so a node that fails or blocks while starting
+    does not keep the others from running.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.instances = {}
+        self.failed = []
+        self.threads = {}
+        self.stopping = threading.Event()
+
+    def start(self):
+        for name in self.names:
+            thread = threading.Thread(target=self.run_node, args=(name,), name=name, daemon=True)
+            thread.start()
+            self.threads[name] = thread
+
+    def run_node(self, name):
+        module, cls = NODES[name]
+        try:
+            instance = getattr(importlib.import_module(module), cls)()
+            self.instances[name] = instance
+            if self.stopping.is_set():
+                instance.node.shutdown_requested.set()
+            if asyncio.iscoroutinefunction(instance.run):
+                asyncio.run(instance.run())
+            else:
+                instance.run()
+        except Exception:
+            print(f'node_runner: {name} failed')
+            traceback.print_exc()
+            self.failed.append(name)
+
+    def shutdown(self):
+        """
+        Ask every hosted node to stop, as NodeManager.shutdown() would.
+        Nodes still starting are stopped as soon as they are created.
+        """
+        self.stopping.set()
+        manager = mw.NodeManager()
+        for name, instance in list(self.instances.items()):
+            instance.node.shutdown_requested.set()
+            manager.shutdown(name)
+
+    def running(self):
+        return [name for name, thread in self.threads.items() if thread.is_alive()]
+
+    def wait(self, timeout=None):
+        """
+        Block until all nodes stopped, or timeout seconds passed.
+        Returns the names of the nodes still running.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads.values():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            thread.join(remaining)
+        return self.running()
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(NODES)
+    unknown = [n for n in names if n not in NODES]
+    if unknown:
+        print(f'node_runner: unknown nodes {", ".join(unknown)}, known nodes are {", ".join(NODES)}')
+        sys.exit(1)
+    mw.enable_cache()
+    runner = NodeRunner(names)
+    # stop the nodes on SIGTERM as on ctrl-c, signals are only delivered to the main thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stopping.set())
+    runner.start()
+    try:
+        while runner.running() and not runner.stopping.is_set():
+            runner.wait(timeout=1.0)
+    except KeyboardInterrupt:
+        pass
+    runner.shutdown()
+    left = runner.wait(SHUTDOWN_TIMEOUT)
+    if left:
+        print(f'node_runner: {", ".join(left)} did not stop')
+    sys.exit(1 if runner.failed or left else 0)
@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+
+
+"""
+
+Recorder node.
+
+Records every change to the middleware, fields and other keys written through it, in a compressed append-only log.
+Use replay.py to feed a recording back into the middleware.
+
+The log is a gzip file of json lines. The first line is a header:
+
+    {"version": 1, "time": <unix time of the start>, "storage": "keys", "prefixes": []}
+
+Each following line is a change, [t, key, value], where t is the time in seconds since the start,
+key is the field name as <prefix>_<field>, and value is the payload as stored, or null if the key was deleted.
+Binary payloads are stored as [t, key, base64, "b64"].
+The values of all keys when the recording starts are recorded first, at t = 0.
+Changes seen together, such as the fields written by a transaction, share the same t and are replayed together.
+
+Values are read when their change is announced, a value overwritten before it is read is recorded once, with its last value.
+The log is flushed every FLUSH_PERIOD seconds, a recorder that is killed leaves a log readable up to its last flush.
+
+Only keys are recorded. LED frames shown through the frame ring, see middleware.FrameRing, never reach the database,
+and the commands of queue_* lists are taken by their driver as they come, see middleware.CommandQueue.
+Neither is recorded, the recorder logs a warning when it sees them in use. A replay writes the fields that
+the commands changed, such as leds_brightness, but not the LED frames, nor the commands themselves.
+
+usage: python3 recorder.py <recording.jsonl.gz> [prefix ...]
+
+With prefixes, only keys starting with one of them are recorded.
+
+"""
+
+
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+import middleware as mw
+
+
+RECORDING_VERSION = 1
+
+# seconds between flushes of the log
+FLUSH_PERIOD = 1.0
+
+
+def encode_change(t, key, raw):
+    """
+    Line of the log for a change of key to the raw payload, None if it was deleted.
+    """
+    if raw is None:
+        change = [t, key, None]
+    else:
+        try:
+            change = [t, key, raw.decode()]
+        except UnicodeDecodeError:
+            change = [t, key, base64.b64encode(raw).decode(), "b64"]
+    return json.dumps(change, separators=(",", ":")) + "\n"
+
+def decode_change(line):
+    """
+    Returns the (t, key, raw) of a line of the log.
+    """
+    change = json.loads(line)
+    t, key, value = change[:3]
+    if value is None:
+        return t, key, None
+    if len(change) > 3 and change[3] == "b64":
+        return t, key, base64.b64decode(value)
+    return t, key, value.encode()
+
+def read_lines(path):
+    """
+    Yield the complete lines of a log, decompressed as they are read.
+    Unlike gzip.open(), stops at the last complete line of a log cut short, by a recorder that was killed.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            pending += decompressor.decompress(chunk)
+            *lines, pending = pending.split(b"\n")
+            yield from lines
+
+def read_recording(path):
+    """
+    Read a recording.
+    Returns the header, and a generator of (t, key, raw) changes.
+    """
+    lines = read_lines(path)
+    header = json.loads(next(lines))
+    if header.get("version") != RECORDING_VERSION:
+        raise ValueError(f'{path}: unsupported recording version {header.get("version")}')
+    return header, (decode_change(line) for line in lines)
+
+def read_keys(keys):
+    """
+    Read the raw payloads of keys, fields or plain keys, in a single round trip.
+    Returns a dictionary of keys with their payload, None for the keys that do not exist.
+    Keys that do not hold a string, such as sets, are left out.
+    """
+    pipe = mw.connection.pipeline(transaction=False)
+    for key in keys:
+        found = mw.find_field(key)
+        if mw.STORAGE == "hash" and found is not None:
+            pipe.hget(found[0].prefix, found[1])
+        else:
+            pipe.get(key)
+    return {k: v for k, v in zip(keys, pipe.execute(raise_on_error=False)) if not isinstance(v, Exception)}
+
+
+class Recorder:
+
+    def __init__(self, path, prefixes=()):
+        """
+        Connect to middleware.
+        Initialize node.
+        Create the log.
+        """
+        self.path = path
+        self.prefixes = tuple(prefixes)
+        self.node = mw.Node("recorder")
+        self.log = gzip.open(path, "wb")
+        self.changes = 0
+        self.warned = set()
+
+    def is_recorded(self, key):
+        if mw.is_internal_key(key) or key.startswith("node_") or key.endswith("_is_shutdown"):
+            return False
+        # with the hash layout, fields are announced on their field channels rather than by the hash
+        if mw.STORAGE == "hash" and key in mw.entries:
+            return False
+        return not self.prefixes or key.startswith(self.prefixes)
+
+    def warn_unrecorded(self, what):
+        """
+        Log once that traffic the recording misses is in use.
+        """
+        if what not in self.warned:
+            self.warned.add(what)
+            self.node.logwarn(f'{what} are not recorded, see recorder.py')
+
+    def write(self, t, values):
+        for key, raw in values.items():
+            self.log.write(encode_change(t, key, raw).encode())
+        self.changes += len(values)
+
+    def initial_keys(self):
+        keys = []
+        for key in mw.find_keys():
+            if mw.STORAGE == "hash" and key in mw.entries:
+                keys += [mw.entries[key].key(f) for f in mw.entries[key].fields]
+            else:
+                keys.append(key)
+        return [k for k in keys if self.is_recorded(k)]
+
+    def run(self):
+        """
+        Main loop.
+        """
+        mw.enable_notifications()
+        keyspace = f'__keyspace@{mw.get_db()}__:'
+        pubsub = mw.connection.pubsub(ignore_subscribe_messages=True)
+        # fields written by a transaction are announced together on the transaction channel, and recorded together
+        pubsub.psubscribe(keyspace + "*", mw.field_channel("*"), mw.transaction_channel())
+        announced = mw.AnnouncedKeys()
+        try:
+            start = time.monotonic()
+            header = {"version": RECORDING_VERSION, "time": time.time(), "storage": mw.STORAGE, "prefixes": list(self.prefixes)}
+            self.log.write((json.dumps(header) + "\n").encode())
+            initial = read_keys(self.initial_keys())
+            self.write(0.0, {k: v for k, v in initial.items() if v is not None})
+            self.node.loginfo(f'recording {len(initial)} keys to {self.path}')
+            if os.path.exists(mw.FRAME_RING_PATH.format(db=mw.get_db())):
+                self.warn_unrecorded("LED frames of the frame ring")
+            flushed = time.monotonic()
+            while not self.node.is_shutdown():
+                message = pubsub.get_message(timeout=FLUSH_PERIOD)
+                # read the keys of all the messages already received in a single round trip
+                changed = []
+                while message is not None:
+                    keys = announced.changed(message)
+                    if any(k.startswith("queue_") for k in keys):
+                        self.warn_unrecorded("commands of the queue_* lists")
+                    changed += [k for k in keys if k not in changed and self.is_recorded(k)]
+                    message = pubsub.get_message(timeout=0.0)
+                if changed:
+                    self.write(round(time.monotonic() - start, 3), read_keys(changed))
+                if time.monotonic() - flushed >= FLUSH_PERIOD:
+                    self.log.flush(zlib.Z_SYNC_FLUSH)
+                    flushed = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pubsub.close()
+            self.log.close()
+            self.node.loginfo(f'recorded {self.changes} changes')
+            self.node.shutdown()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python3 recorder.py <recording.jsonl.gz> [prefix ...]")
+        sys.exit(1)
+    node = Recorder(sys.argv[1], sys.argv[2:])
+    node.run()
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+
+
+"""
+
+Replay a recording made by recorder.py.
+
+Writes the recorded changes back into the middleware, in their recorded order, at real or accelerated speed.
+Changes recorded together are written in a single MULTI/EXEC, fields through their entry,
+so they end up in the right place for the configured storage layout, with their history and change notifications.
+
+Replay into a scratch database, or into the local backend, so the robot's own nodes do not see the recorded values.
+With --nodes, the listed nodes are hosted in the replay process, see node_runner.py, once the initial values are written.
+This runs them against the recording with the local backend, without a redis server:
+
+    MIDDLEWARE_BACKEND=local python3 replay.py session.jsonl.gz --exclude=touch_sensors_touch_* --nodes touch_calibrator
+
+usage: python3 replay.py <recording> [--speed=<factor>] [--exclude=<pattern>,...] [--nodes node ...]
+       python3 replay.py info <recording>
+
+--speed=2 replays twice as fast, --speed=0 as fast as possible.
+--exclude skips the keys matching glob patterns, such as the outputs of the hosted nodes.
+
+"""
+
+
+import fnmatch
+import sys
+import time
+
+import middleware as mw
+import node_runner
+import recorder
+
+
+def batches(changes):
+    """
+    Group the changes recorded together.
+    Yields the time and the list of (key, raw) changes of each group.
+    """
+    current, group = None, []
+    for t, key, raw in changes:
+        if group and t != current:
+            yield current, group
+            group = []
+        current = t
+        group.append((key, raw))
+    if group:
+        yield current, group
+
+def queue_changes(pipe, changes):
+    """
+    Add the commands that write the raw changes to pipe, which must be a MULTI/EXEC pipeline.
+    Returns the transaction holding the field writes.
+    """
+    transaction = mw.Transaction()
+    for key, raw in changes:
+        found = mw.find_field(key)
+        if found is None:
+            if raw is None:
+                pipe.delete(key)
+            else:
+                pipe.set(key, raw)
+                mw.register_keys(pipe, [key])
+        elif raw is None:
+            entry, field = found
+            if mw.STORAGE == "hash":
+                pipe.hdel(entry.prefix, field)
+            else:
+                pipe.delete(key)
+        else:
+            entry, field = found
+            transaction.add(entry(), {field: entry.decode(field, raw)})
+    if transaction.writes:
+        transaction.queue(pipe)
+    return transaction
+
+
+class Replay:
+    """
+    Replay class.
+    Use run() to replay a recording, optionally hosting nodes once the initial values are written.
+    """
+
+    def __init__(self, path, speed=1.0, exclude=(), nodes=()):
+        self.path = path
+        self.speed = speed
+        self.exclude = list(exclude)
+        self.nodes = list(nodes)
+        self.node = mw.Node("replay")
+        self.runner = None
+        self.changes = 0
+        self.max_lag = 0.0
+
+    def is_excluded(self, key):
+        return any(fnmatch.fnmatchcase(key, p) for p in self.exclude)
+
+    def write(self, changes):
+        pipe = mw.connection.pipeline()
+        transaction = queue_changes(pipe, changes)
+        if len(pipe):
+            pipe.execute()
+        if mw.cache is not None:
+            transaction.update_cache()
+        self.changes += len(changes)
+
+    def run(self):
+        """
+        Main loop.
+        """
+        try:
+            header, changes = recorder.read_recording(self.path)
+            self.node.loginfo(f'replaying {self.path}, recorded {time.ctime(header["time"])}, at {self.speed or "full"} speed')
+            start = None
+            for t, group in batches(changes):
+                if self.node.is_shutdown():
+                    break
+                group = [(k, raw) for k, raw in group if not self.is_excluded(k)]
+                if start is None:
+                    start = time.monotonic() - (t / self.speed if self.speed else 0.0)
+                elif self.speed:
+                    delay = start + t / self.speed - time.monotonic()
+                    if delay > 0:
+                        self.node.shutdown_requested.wait(delay)
+                    self.max_lag = max(self.max_lag, -delay)
+                if group:
+                    self.write(group)
+                if self.nodes and self.runner is None:
+                    # the hosted nodes start from the recorded initial values
+                    self.runner = node_runner.NodeRunner(self.nodes)
+                    self.runner.start()
+            self.node.loginfo(f'replayed {self.changes} changes, at most {self.max_lag * 1000:.1f} ms behind the recording')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.runner is not None:
+                self.runner.shutdown()
+                self.runner.wait(node_runner.SHUTDOWN_TIMEOUT)
+            self.node.shutdown()
+
+
+def print_info(path):
+    """
+    Print the duration of a recording and its busiest keys.
+    """
+    header, changes = recorder.read_recording(path)
+    counts = {}
+    duration = 0.0
+    for t, key, raw in changes:
+        counts[key] = counts.get(key, 0) + 1
+        duration = t
+    print(f'recorded {time.ctime(header["time"])}, {header["storage"]} storage, {duration:.1f} s, {sum(counts.values())} changes')
+    print(f'{"key":40s} {"changes":>10s} {"rate":>10s}')
+    for key, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+        print(f'{key:40s} {n:10d} {n / duration if duration else 0.0:8.1f}/s')
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    options = dict(a[2:].split("=", 1) for a in sys.argv[1:] if a.startswith("--") and "=" in a)
+    if len(args) == 2 and args[0] == "info":
+        print_info(args[1])
+        sys.exit(0)
+    if not args:
+        print("usage: python3 replay.py <recording> [--speed=<factor>] [--exclude=<pattern>,...] [--nodes node ...]")
+        print("       python3 replay.py info <recording>")
+        sys.exit(1)
+    nodes = args[1:] if "--nodes" in sys.argv else []
+    unknown = [n for n in nodes if n not in node_runner.NODES]
+    if unknown:
+        print(f'replay: unknown nodes {", ".join(unknown)}, known nodes are {", ".join(node_runner.NODES)}')
+        sys.exit(1)
+    exclude = options["exclude"].split(",") if "exclude" in options else []
+    if nodes:
+        mw.enable_cache()
+    replay = Replay(args[0], float(options.get("speed", 1.0)), exclude, nodes)
+    replay.run()
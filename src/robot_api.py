@@ -16,6 +16,9 @@ import middleware as mw
 
 SERVER_PORT = 8001
 
+# seconds update_leds_icon waits for the leds driver to load the icon
+ICON_TIMEOUT = 5.0
+
 
 app = Flask(
     __name__,
@@ -23,6 +26,9 @@ app = Flask(
 )
 
 
+mw.enable_cache()
+
+
 class Robot:
 
     mw_battery = mw.Battery()
@@ -38,62 +44,53 @@ class Robot:
     mw_behaviours = mw.Behaviours()
 
     def __init__(self):
-        self.battery = self.mw_battery.voltage
-        self.battery_percentage = self.mw_battery.percentage
-        self.pan = self.mw_pan.current_angle
-        self.tilt = self.mw_tilt.current_angle
-        self.pan_min = self.mw_pan.min_angle
-        self.pan_max = self.mw_pan.max_angle
-        self.tilt_min = self.mw_tilt.min_angle
-        self.tilt_max = self.mw_tilt.max_angle
-        self.pan_torque = self.mw_pan.enabled
-        self.tilt_torque = self.mw_tilt.enabled
-        self.pan_temperature = self.mw_pan.temperature
-        self.tilt_temperature = self.mw_tilt.temperature
-        self.touch_chest = self.mw_touch_sensors.touch_chest
-        self.touch_head_n = self.mw_touch_sensors.touch_head_0
-        self.touch_head_s = self.mw_touch_sensors.touch_head_1
-        self.touch_head_e = self.mw_touch_sensors.touch_head_2
-        self.touch_head_w = self.mw_touch_sensors.touch_head_3
-        self.behaviour_look_around = self.mw_behaviours.look_around
-        self.behaviour_blush = self.mw_behaviours.blush
-        self.video_list = self.mw_server.get_video_list()
-        self.sound_list = self.mw_server.get_sound_list()
-        self.image_list = self.mw_server.get_image_list()
-        self.icon_list = self.mw_server.get_icon_list()
-        self.volume = self.mw_speakers.volume
-        self.multimedia_port = self.mw_server.http_port
-        self.microphone_is_recording = self.mw_microphone.is_recording
-        self.recognized_speech = self.mw_onboard.speech
+        self.update()
 
     def update(self):
-        self.battery = self.mw_battery.voltage
-        self.battery_percentage = self.mw_battery.percentage
-        self.pan = self.mw_pan.current_angle
-        self.tilt = self.mw_tilt.current_angle
-        self.pan_min = self.mw_pan.min_angle
-        self.pan_max = self.mw_pan.max_angle
-        self.tilt_min = self.mw_tilt.min_angle
-        self.tilt_max = self.mw_tilt.max_angle
-        self.pan_torque = self.mw_pan.enabled
-        self.tilt_torque = self.mw_tilt.enabled
-        self.pan_temperature = self.mw_pan.temperature
-        self.tilt_temperature = self.mw_tilt.temperature
-        self.touch_chest = self.mw_touch_sensors.touch_chest
-        self.touch_head_n = self.mw_touch_sensors.touch_head_0
-        self.touch_head_s = self.mw_touch_sensors.touch_head_1
-        self.touch_head_e = self.mw_touch_sensors.touch_head_2
-        self.touch_head_w = self.mw_touch_sensors.touch_head_3
-        self.behaviour_look_around = self.mw_behaviours.look_around
-        self.behaviour_blush = self.mw_behaviours.blush
-        self.video_list = self.mw_server.get_video_list()
-        self.sound_list = self.mw_server.get_sound_list()
-        self.image_list = self.mw_server.get_image_list()
-        self.icon_list = self.mw_server.get_icon_list()
-        self.volume = self.mw_speakers.volume
-        self.multimedia_port = self.mw_server.http_port
-        self.microphone_is_recording = self.mw_microphone.is_recording
-        self.recognized_speech = self.mw_onboard.speech
+        self.update_state()
+        self.update_media()
+
+    def update_state(self):
+        requests = (
+            (self.mw_battery, ("voltage", "percentage")),
+            (self.mw_pan, ("current_angle", "min_angle", "max_angle", "enabled", "temperature")),
+            (self.mw_tilt, ("current_angle", "min_angle", "max_angle", "enabled", "temperature")),
+            (self.mw_touch_sensors, ("touch_chest", "touch_head_0", "touch_head_1", "touch_head_2", "touch_head_3")),
+            (self.mw_behaviours, ("look_around", "blush")),
+            (self.mw_speakers, ("volume",)),
+            (self.mw_server, ("http_port",)),
+            (self.mw_microphone, ("is_recording",)),
+            (self.mw_onboard, ("speech",)),
+        )
+        battery, pan, tilt, touch_sensors, behaviours, speakers, server, microphone, onboard = mw.snapshot(*requests)
+        # seconds since each field was written, None if it never was, so clients can spot a driver that stopped
+        ages = mw.read_ages([(entry, f) for entry, fields in requests for f in fields])
+        self.field_age = {k: None if age is None else round(age, 3) for k, age in ages.items()}
+        self.battery = battery["voltage"]
+        self.battery_percentage = battery["percentage"]
+        self.pan = pan["current_angle"]
+        self.tilt = tilt["current_angle"]
+        self.pan_min = pan["min_angle"]
+        self.pan_max = pan["max_angle"]
+        self.tilt_min = tilt["min_angle"]
+        self.tilt_max = tilt["max_angle"]
+        self.pan_torque = pan["enabled"]
+        self.tilt_torque = tilt["enabled"]
+        self.pan_temperature = pan["temperature"]
+        self.tilt_temperature = tilt["temperature"]
+        self.touch_chest = touch_sensors["touch_chest"]
+        self.touch_head_n = touch_sensors["touch_head_0"]
+        self.touch_head_s = touch_sensors["touch_head_1"]
+        self.touch_head_e = touch_sensors["touch_head_2"]
+        self.touch_head_w = touch_sensors["touch_head_3"]
+        self.behaviour_look_around = behaviours["look_around"]
+        self.behaviour_blush = behaviours["blush"]
+        self.volume = speakers["volume"]
+        self.multimedia_port = server["http_port"]
+        self.microphone_is_recording = microphone["is_recording"]
+        self.recognized_speech = onboard["speech"]
+
+    def update_media(self):
         self.video_list = self.mw_server.get_video_list()
         self.sound_list = self.mw_server.get_sound_list()
         self.image_list = self.mw_server.get_image_list()
@@ -128,19 +125,19 @@ class Robot:
         return True, "OK"
 
     def update_motor_limits(self, pan_min, pan_max, tilt_min, tilt_max):
-        self.mw_pan.min_angle = pan_min
-        self.mw_pan.max_angle = pan_max
-        self.mw_tilt.min_angle = tilt_min
-        self.mw_tilt.max_angle = tilt_max
+        # the driver never sees the limits of one servo updated without the other's
+        with mw.transaction():
+            self.mw_pan.update(min_angle=pan_min, max_angle=pan_max)
+            self.mw_tilt.update(min_angle=tilt_min, max_angle=tilt_max)
         return True, "OK"
 
     def play_sound(self, name):
         url = self.mw_server.url_for_sound(name)
-        self.mw_speakers.url = url
+        self.mw_speakers.play(url)
         return True, "OK"
 
     def pause_audio(self):
-        self.mw_speakers.url = None
+        self.mw_speakers.stop()
         return True, "OK"
 
     def set_volume(self, v):
@@ -161,33 +158,43 @@ class Robot:
         correct_size = all([len(c) == 3 for c in colors])
         if not correct_size:
             return False, "Colors must be 3-tuples"
-        self.mw_leds.colors = colors
+        self.mw_leds.show(self.mw_leds.encode_colors(colors))
         return True, "OK"
 
     def update_leds_icon(self, name):
         url = self.mw_server.url_for_icon(name)
-        self.mw_leds.load_from_url(url)
+        id = self.mw_leds.show_icon(url)
+        status = self.mw_leds.commands().wait(id, timeout=ICON_TIMEOUT)
+        if status is None or status["state"] in ("queued", "running"):
+            return False, "Leds driver did not load the icon in time"
+        if status["state"] == "failed":
+            return False, status["result"]
         return True, "OK"
 
     def set_screen(self, image=None, video=None, text=None, url=None):
+        # all four fields are written at once, with a single change notification,
+        # so the onboard page never sees a mix of old and new
+        screen = {}
         if image != "":
             url = self.mw_server.url_for_image(image)
-            self.mw_onboard.image = url
+            screen["image"] = url
         else:
-            self.mw_onboard.image = None
+            screen["image"] = None
         if video != "":
             url = self.mw_server.url_for_video(video)
-            self.mw_onboard.video = url
+            screen["video"] = url
         else:
-            self.mw_onboard.video = None
+            screen["video"] = None
         if text != "":
-            self.mw_onboard.text = text
+            screen["text"] = text
         else:
-            self.mw_onboard.text = None
+            screen["text"] = None
         if url != "":
-            self.mw_onboard.url = url
+            screen["url"] = url
         else:
-            self.mw_onboard.url = None
+            screen["url"] = None
+        with mw.transaction():
+            self.mw_onboard.update(**screen)
         return True, "OK"
 
     def reboot(self):
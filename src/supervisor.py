@@ -0,0 +1,277 @@
+#! /usr/bin/env python
+
+
+"""
+
+Supervisor node.
+
+Starts the nodes of the robot in dependency order, and restarts the ones that crash.
+
+The node graph, cfg/nodes.json by default, lists the nodes by name, each with:
+
+- command: the command that starts the node in its own process, run from src/.
+  Nodes without a command are hosted in the supervisor process, see node_runner.py.
+- ready: the fields, such as leds_ready, that the node sets once it is ready.
+  A node without ready fields is ready as soon as it started.
+- after: the nodes that must be ready before the node starts.
+
+Nodes whose dependencies are ready start together.
+A node that exits with an error is started again after a delay, doubled on every crash up to RESTART_DELAY_MAX.
+The supervisor records when each node got ready and when the first LED frame was shown, under the key BOOT_KEY.
+
+usage: python3 supervisor.py [nodes.json]
+       python3 supervisor.py boot
+
+"""
+
+
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+import middleware as mw
+import node_runner
+
+
+# the commands of the graph are run from this directory, wherever the supervisor is started from
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+GRAPH_PATH = os.path.join(SRC_DIR, "..", "cfg", "nodes.json")
+
+# key storing the metrics of the last boot
+BOOT_KEY = "supervisor_boot"
+
+LOOP_PERIOD = 0.1
+RESTART_DELAY = 1.0
+RESTART_DELAY_MAX = 60.0
+# the restart delay of a node that ran this long before crashing starts over
+STABLE_TIME = 60.0
+SHUTDOWN_TIMEOUT = 10.0
+
+
+def load_graph(path):
+    """
+    Load and check a node graph.
+    Returns a dictionary of nodes with their command, ready fields and dependencies.
+    """
+    with open(path) as f:
+        graph = json.load(f)
+    nodes = {}
+    for name, config in graph.items():
+        nodes[name] = {
+            "command": config.get("command"),
+            "ready": list(config.get("ready", [])),
+            "after": list(config.get("after", [])),
+        }
+        if nodes[name]["command"] is None and name not in node_runner.NODES:
+            raise ValueError(f'{name}: no command, and node_runner.py cannot host it')
+        for key in nodes[name]["ready"]:
+            if mw.find_field(key) is None:
+                raise ValueError(f'{name}: {key} is not a field')
+    for name, config in nodes.items():
+        for dependency in config["after"]:
+            if dependency not in nodes:
+                raise ValueError(f'{name}: depends on unknown node {dependency}')
+    # a node can only start once all its dependencies can
+    ordered = set()
+    while len(ordered) < len(nodes):
+        startable = [n for n, c in nodes.items() if n not in ordered and all(d in ordered for d in c["after"])]
+        if not startable:
+            raise ValueError(f'dependency cycle between {", ".join(n for n in nodes if n not in ordered)}')
+        ordered.update(startable)
+    return nodes
+
+
+class Child:
+    """
+    Child class.
+    A node started by the supervisor, in its own process or hosted in the supervisor.
+    """
+
+    def __init__(self, name, command, ready, after):
+        self.name = name
+        self.command = command
+        self.fields = [mw.find_field(key) for key in ready]
+        self.after = after
+        self.process = None
+        self.runner = None
+        self.started = None
+        self.is_ready = False
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        self.next_start = 0.0
+
+    def start(self):
+        # ready fields left over by a previous run would make the node look ready at once
+        for cls, field in self.fields:
+            mw.write_fields(cls(), {field: False})
+        if self.command is None:
+            self.runner = node_runner.NodeRunner([self.name])
+            self.runner.start()
+        else:
+            args = [sys.executable if a == "python" else a for a in shlex.split(self.command)]
+            self.process = subprocess.Popen(args, cwd=SRC_DIR)
+        self.started = time.monotonic()
+        self.is_ready = False
+
+    def poll(self):
+        """
+        Returns None while the node runs, or its exit code.
+        """
+        if self.runner is not None:
+            if self.runner.running():
+                return None
+            return 1 if self.runner.failed else 0
+        return self.process.poll()
+
+    def is_running(self):
+        return self.started is not None and self.poll() is None
+
+    def check_ready(self):
+        if self.fields:
+            values = mw.read_fields([(cls(), field) for cls, field in self.fields])
+            return all(values.values())
+        return True
+
+    def stop(self):
+        if not self.is_running():
+            return
+        if self.runner is not None:
+            self.runner.shutdown()
+        elif mw.NodeManager().is_alive(self.name):
+            mw.NodeManager().shutdown(self.name)
+        else:
+            # not a node, such as mjpeg_server_2, or one not started yet, nothing reads its shutdown key
+            self.process.terminate()
+
+    def kill(self):
+        if self.process is not None and self.is_running():
+            self.process.terminate()
+
+
+class Supervisor:
+
+    def __init__(self, graph_path=GRAPH_PATH):
+        """
+        Connect to middleware.
+        Initialize node.
+        Load node graph.
+        """
+        mw.enable_cache()
+        self.node = mw.Node("supervisor")
+        self.children = {name: Child(name, **config) for name, config in load_graph(graph_path).items()}
+        self.leds = mw.Leds()
+        self.metrics = {"time": time.time(), "boot_s": None, "eyes_s": None, "nodes": {}}
+
+    def elapsed(self):
+        return time.monotonic() - self.boot_start
+
+    def save_metrics(self):
+        mw.set_key(BOOT_KEY, self.metrics)
+
+    def step(self):
+        now = time.monotonic()
+        for child in self.children.values():
+            metrics = self.metrics["nodes"].setdefault(child.name, {"ready_s": None, "restarts": 0})
+            if child.started is None:
+                if now >= child.next_start and all(self.children[d].is_ready for d in child.after):
+                    self.node.loginfo(f'starting {child.name}')
+                    child.start()
+                continue
+            code = child.poll()
+            if code is not None:
+                if code == 0:
+                    # a node that was asked to shutdown is not started again
+                    self.node.loginfo(f'{child.name} stopped')
+                    child.next_start = float("inf")
+                    child.started = None
+                    child.is_ready = False
+                    continue
+                # restart with a growing delay, unless the node ran long enough to be considered stable
+                if now - child.started >= STABLE_TIME:
+                    child.delay = RESTART_DELAY
+                self.node.logwarn(f'{child.name} exited with {code}, restarting in {child.delay:.0f} s')
+                child.next_start = now + child.delay
+                child.delay = min(2 * child.delay, RESTART_DELAY_MAX)
+                child.started = None
+                child.is_ready = False
+                child.restarts += 1
+                metrics["restarts"] = child.restarts
+                self.save_metrics()
+            elif not child.is_ready and child.check_ready():
+                child.is_ready = True
+                ready_s = now - child.started
+                self.node.loginfo(f'{child.name} ready in {ready_s:.2f} s')
+                if metrics["ready_s"] is None:
+                    metrics["ready_s"] = ready_s
+                    metrics["ready_at_s"] = self.elapsed()
+                    self.save_metrics()
+        if self.metrics["eyes_s"] is None and self.leds.sequence != self.first_frame:
+            self.metrics["eyes_s"] = self.elapsed()
+            self.node.loginfo(f'first frame shown {self.metrics["eyes_s"]:.2f} s after boot')
+            self.save_metrics()
+        if self.metrics["boot_s"] is None and all(c.is_ready for c in self.children.values()):
+            self.metrics["boot_s"] = self.elapsed()
+            self.node.loginfo(f'all nodes ready {self.metrics["boot_s"]:.2f} s after boot')
+            self.save_metrics()
+
+    def stop(self):
+        """
+        Ask all nodes to shutdown, and terminate the processes that did not in time.
+        """
+        for child in self.children.values():
+            child.stop()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while time.monotonic() < deadline and any(c.is_running() for c in self.children.values()):
+            time.sleep(LOOP_PERIOD)
+        for child in self.children.values():
+            child.kill()
+
+    def run(self):
+        """
+        Main loop.
+        """
+        try:
+            self.boot_start = time.monotonic()
+            self.first_frame = self.leds.sequence
+            self.save_metrics()
+            while not self.node.is_shutdown():
+                self.step()
+                time.sleep(LOOP_PERIOD)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.node.shutdown()
+
+
+def print_boot():
+    """
+    Print the metrics of the last boot.
+    """
+    try:
+        metrics = mw.get_key(BOOT_KEY)
+    except TypeError:
+        print("no boot recorded")
+        return
+    def seconds(value):
+        return "-" if value is None else f'{value:.2f} s'
+    print(f'boot at {time.ctime(metrics["time"])}')
+    print(f'all nodes ready after {seconds(metrics["boot_s"])}, first frame after {seconds(metrics["eyes_s"])}')
+    print(f'{"node":30s} {"ready at":>10s} {"ready in":>10s} {"restarts":>9s}')
+    nodes = sorted(metrics["nodes"].items(), key=lambda kv: kv[1].get("ready_at_s") or float("inf"))
+    for name, node in nodes:
+        print(f'{name:30s} {seconds(node.get("ready_at_s")):>10s} {seconds(node["ready_s"]):>10s} {node["restarts"]:9d}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "boot":
+        print_boot()
+    else:
+        supervisor = Supervisor(sys.argv[1] if len(sys.argv) > 1 else GRAPH_PATH)
+        # stop the nodes on SIGTERM as on ctrl-c, rather than leaving the processes it started behind
+        signal.signal(signal.SIGTERM, lambda signum, frame: supervisor.node.shutdown_requested.set())
+        supervisor.run()
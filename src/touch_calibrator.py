@@ -11,108 +11,109 @@ The raw values are compared to a moving average of the raw values.
 
 If the raw values are below the moving average, a touch event is triggered.
 
-The moving average is calculated over a window of values.
+The moving average is calculated over the values of the last WINDOW_TIME seconds.
 
-The window size and sensitivity can be configured.
+The window length and sensitivity can be configured.
+
+Raw values are only published when they move, see TouchSensors.write_policies,
+so the calibrator looks at the values in effect over a time span rather than at the last samples.
 
 """
 
 
+import time
 import numpy as np
 
 
-import time
 import middleware as mw
 
 
-WINDOW_SIZE = 100
+# seconds of raw values in the moving average, the calibration waits for a full window
+WINDOW_TIME = 10.0
+# seconds a raw value must stay below the moving average to count as a touch
+TOUCH_TIME = 0.3
+RAW_FIELDS = ("chest_raw", "head_0_raw", "head_1_raw", "head_2_raw", "head_3_raw")
+
+
+def values_since(times, values, since):
+    """
+    Values in effect since a timestamp: the ones published after it, and the last one published before it.
+    """
+    first = max(0, np.searchsorted(times, since, side="right") - 1)
+    return values[first:]
+
+
+class Window:
+    """
+    Values of a raw field in effect over the last WINDOW_TIME seconds.
+    """
+
+    def __init__(self):
+        self.times = []
+        self.values = []
+
+    def add(self, times, values, now):
+        self.times += list(times)
+        self.values += list(values)
+        # keep the value in effect at the start of the window
+        first = max(0, int(np.searchsorted(self.times, now - WINDOW_TIME, side="right")) - 1)
+        del self.times[:first]
+        del self.values[:first]
+
+    def is_full(self, now):
+        return len(self.times) > 0 and self.times[0] <= now - WINDOW_TIME
 
 
 class TouchCalibrator:
 
     def __init__(self):
-        self.windows = {
-            "chest": [],
-            "head_0": [],
-            "head_1": [],
-            "head_2": [],
-            "head_3": [],
-        }
         self.touch_sensors = mw.TouchSensors()
         self.node = mw.Node("touch_calibrator")
+        self.windows = {f: Window() for f in RAW_FIELDS}
+        self.last_ids = {}
+
+    def update_windows(self):
+        """
+        Add the raw values recorded since the last update to the windows.
+        """
+        now = time.time()
+        for field, (times, values) in self.touch_sensors.history_after(self.last_ids).items():
+            self.windows[field].add(times, values, now)
+        return now
 
     def run(self):
         try:
             self.node.loginfo("waiting for touch sensors to be ready")
             while not self.node.is_shutdown():
-                time.sleep(0.1)
+                self.node.wait_for_change(self.touch_sensors, "ready", timeout=1.0)
                 if self.touch_sensors.ready:
                     break
             self.node.loginfo("calibrating")
-            while not self.node.is_shutdown(): 
-                time.sleep(0.1)
-                chest_raw = self.touch_sensors.chest_raw
-                head_0_raw = self.touch_sensors.head_0_raw
-                head_1_raw = self.touch_sensors.head_1_raw
-                head_2_raw = self.touch_sensors.head_2_raw
-                head_3_raw = self.touch_sensors.head_3_raw
-                self.windows["chest"].append(chest_raw)
-                self.windows["head_0"].append(head_0_raw)
-                self.windows["head_1"].append(head_1_raw)
-                self.windows["head_2"].append(head_2_raw)
-                self.windows["head_3"].append(head_3_raw)
-                if len(self.windows["chest"]) > WINDOW_SIZE:
+            # raw values are recorded by the middleware, start from the values in effect a window ago
+            start = time.time() - WINDOW_TIME
+            for field, (times, values) in self.touch_sensors.history(*RAW_FIELDS, end=start, last=1).items():
+                self.windows[field].add(times, values, start)
+            self.last_ids = {f: start for f in RAW_FIELDS}
+            while not self.node.is_shutdown():
+                self.node.wait_for_change(self.touch_sensors, *RAW_FIELDS, timeout=0.5)
+                if self.windows["chest_raw"].is_full(self.update_windows()):
                     self.node.loginfo("calibration complete")
                     break
             while not self.node.is_shutdown():
-                time.sleep(0.1)
-                # get values
-                chest_raw = self.touch_sensors.chest_raw
-                head_0_raw = self.touch_sensors.head_0_raw
-                head_1_raw = self.touch_sensors.head_1_raw
-                head_2_raw = self.touch_sensors.head_2_raw
-                head_3_raw = self.touch_sensors.head_3_raw
-                # add to buffers
-                self.windows["chest"].append(chest_raw)
-                self.windows["head_0"].append(head_0_raw)
-                self.windows["head_1"].append(head_1_raw)
-                self.windows["head_2"].append(head_2_raw)
-                self.windows["head_3"].append(head_3_raw)
-                # remove old values
-                self.windows["chest"] = self.windows["chest"][-WINDOW_SIZE:]
-                self.windows["head_0"] = self.windows["head_0"][-WINDOW_SIZE:]
-                self.windows["head_1"] = self.windows["head_1"][-WINDOW_SIZE:]
-                self.windows["head_2"] = self.windows["head_2"][-WINDOW_SIZE:]
-                self.windows["head_3"] = self.windows["head_3"][-WINDOW_SIZE:]
-                # calculate bounds
+                # a value that stays below the average is not published again, check it at the sensor rate anyway
+                self.node.wait_for_change(self.touch_sensors, *RAW_FIELDS, timeout=0.1)
+                # only the values recorded since the last check are read
+                now = self.update_windows()
                 sensitivity = self.touch_sensors.sensitivity
-                chest_mean = np.mean(self.windows["chest"])
-                chest_upper, chest_lower = chest_mean + sensitivity, chest_mean - sensitivity
-                head_0_mean = np.mean(self.windows["head_0"])
-                head_0_upper, head_0_lower = head_0_mean + sensitivity, head_0_mean - sensitivity
-                head_1_mean = np.mean(self.windows["head_1"])
-                head_1_upper, head_1_lower = head_1_mean + sensitivity, head_1_mean - sensitivity
-                head_2_mean = np.mean(self.windows["head_2"])
-                head_2_upper, head_2_lower = head_2_mean + sensitivity, head_2_mean - sensitivity
-                head_3_mean = np.mean(self.windows["head_3"])
-                head_3_upper, head_3_lower = head_3_mean + sensitivity, head_3_mean - sensitivity
-                # check if latest values are below lower bounds
-                chest_last_3 = self.windows["chest"][-3:]
-                head_0_last_3 = self.windows["head_0"][-3:]
-                head_1_last_3 = self.windows["head_1"][-3:]
-                head_2_last_3 = self.windows["head_2"][-3:]
-                head_3_last_3 = self.windows["head_3"][-3:]
-                touch_chest = all([v < chest_lower for v in chest_last_3])
-                touch_head_0 = all([v < head_0_lower for v in head_0_last_3])
-                touch_head_1 = all([v < head_1_lower for v in head_1_last_3])
-                touch_head_2 = all([v < head_2_lower for v in head_2_last_3])
-                touch_head_3 = all([v < head_3_lower for v in head_3_last_3])
+                touches = {}
+                for field in RAW_FIELDS:
+                    window = self.windows[field]
+                    # touched if the latest values are below the lower bound of the moving average
+                    lower = np.mean(window.values) - sensitivity if window.values else 0
+                    recent = values_since(window.times, np.array(window.values), now - TOUCH_TIME)
+                    touches["touch_" + field[:-len("_raw")]] = bool(len(recent) > 0 and np.all(recent < lower))
                 # update db
-                self.touch_sensors.touch_chest = touch_chest
-                self.touch_sensors.touch_head_0 = touch_head_0
-                self.touch_sensors.touch_head_1 = touch_head_1
-                self.touch_sensors.touch_head_2 = touch_head_2
-                self.touch_sensors.touch_head_3 = touch_head_3
+                self.touch_sensors.update(**touches)
         finally:
             self.node.shutdown()
 